@@ -1,9 +1,38 @@
+import base64
+import collections
+import csv
+import functools
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import mimetypes
+import multiprocessing
 import os
+import queue
+import re
+import shutil
 import sqlite3
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
-from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.utils import secure_filename #S
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; migrations there just skip the file lock
+    fcntl = None
+import click
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, has_app_context, has_request_context
+from flask import Response, abort, before_render_template, send_file, send_from_directory, stream_with_context, template_rendered
+from werkzeug.security import check_password_hash, generate_password_hash, safe_join
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup, escape
+from PIL import Image, ImageOps
 
 # Implement Flask and our database wtm.db
 app = Flask(__name__)
@@ -15,25 +44,685 @@ UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size 
+# Half-written uploads go here instead: it isn't served, but it's on the same disk as static/
+# so os.replace can move a finished file into place in one step
+UPLOAD_TEMP_FOLDER = os.path.join(app.root_path, 'upload_tmp')
+UPLOAD_FILE_MODE = 0o644  # Temp files start out private to us; stored ones are public
 
 # Create uploads directory if it doesn't exist - s 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_FOLDER, 'posts'), exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_FOLDER, 'parties'), exist_ok=True)
+os.makedirs(UPLOAD_TEMP_FOLDER, exist_ok=True)
 
 # Helper function to check allowed file types - s
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Connect to wtm.db
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
 
-# This creates our "parties" table for this database
-def init_db():
+# Resized copies of every uploaded photo, made in the background so uploads return right away
+IMAGE_VARIANTS = {'thumb': 480, 'display': 1200}  # Longest side in pixels
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 2))
+image_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='image-variants')
+ready_variants = set()  # Variant files we already know exist on disk
+
+
+def variant_path(path, size):
+    stem = path.rsplit('.', 1)[0]
+    return f"{stem}_{size}.webp"
+
+
+def make_image_variants(path):
+    """Writes a thumbnail and display-size WebP for an upload (path is relative to static/)"""
+    source = os.path.join(app.static_folder, path)
+    with Image.open(source) as image:
+        if getattr(image, 'is_animated', False):
+            return  # Animated GIFs keep playing from the original
+        # Rotate phone photos upright, then drop EXIF (location, camera info) by re-encoding
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        for size, longest_side in IMAGE_VARIANTS.items():
+            variant = image.copy()
+            variant.thumbnail((longest_side, longest_side))
+            target = os.path.join(app.static_folder, variant_path(path, size))
+            # Write to a temp file first so a half-written image is never served (a unique one,
+            # since two uploads of the same photo can be making the same variant at once)
+            with tempfile.NamedTemporaryFile(dir=UPLOAD_TEMP_FOLDER, suffix='.webp', delete=False) as temp:
+                variant.save(temp, 'WEBP', quality=80, method=4)
+            os.chmod(temp.name, UPLOAD_FILE_MODE)
+            os.replace(temp.name, target)
+            ready_variants.add(variant_path(path, size))
+
+    # Cached fragments showing this image still point at the original upload, so let just those
+    # re-render (if no row uses it yet, the fragment that will show it hasn't been cached)
+    conn = get_db_connection()
+    if conn.execute("SELECT 1 FROM parties WHERE flyer_path = ?", (path,)).fetchone():
+        bump_data_version(conn, 'flyers')
+    if conn.execute("SELECT 1 FROM posts WHERE photo_path = ?", (path,)).fetchone():
+        bump_data_version(conn, 'post_photos')
+    conn.commit()
+    conn.close()
+
+
+def log_variant_errors(future):
+    if future.exception():
+        app.logger.error("Could not make image variants: %s", future.exception())
+
+
+def queue_image_variants(path):
+    image_executor.submit(make_image_variants, path).add_done_callback(log_variant_errors)
+
+
+# Uploads are stored under the SHA-256 of their contents (uploads/ab/cd/abcd....jpg), so the
+# same photo uploaded twice is one file and two uploads can never overwrite each other
+UPLOAD_GRACE_SECONDS = 3600  # Unreferenced files younger than this are left alone (see discard_upload)
+CONTENT_ADDRESSED_UPLOAD = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}')  # Under uploads/
+
+
+UPLOAD_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif'}  # Pillow format -> stored extension
+UPLOAD_JPEG_QUALITY = 90
+
+
+class HashingWriter:
+    """File wrapper that hashes everything written through it"""
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+# Originals are public too, so photos are stored as a fresh copy of their pixels (turned
+# upright) with no EXIF - no GPS position or camera serial. GIFs have no EXIF and keep their bytes
+def write_clean_upload(source, temp):
+    """Writes the cleaned image to temp; returns (SHA-256, extension, animated) or None if it isn't one"""
+    output = HashingWriter(temp)
+    try:
+        with Image.open(source) as image:
+            extension = UPLOAD_FORMATS.get(image.format)
+            animated = getattr(image, 'is_animated', False)
+            if extension == 'gif':
+                with open(source, 'rb') as original:
+                    shutil.copyfileobj(original, output, 64 * 1024)
+            elif extension is not None:
+                icc_profile = image.info.get('icc_profile')  # Colour profile, not personal data
+                upright = ImageOps.exif_transpose(image)
+                if extension == 'jpg':
+                    upright.save(output, 'JPEG', quality=UPLOAD_JPEG_QUALITY, icc_profile=icc_profile)
+                else:
+                    upright.save(output, 'PNG', icc_profile=icc_profile)
+    except (OSError, Image.DecompressionBombError):
+        return None
+    if extension is None:
+        return None
+    return output.digest.hexdigest(), extension, animated
+
+
+def save_upload(file):
+    if not file or file.filename == '' or not allowed_file(file.filename):
+        return None
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_TEMP_FOLDER, suffix='.tmp', delete=False) as received:
+        shutil.copyfileobj(file.stream, received, 64 * 1024)
+    # The cleaned copy is hashed as it's written, since its name isn't known until the last byte.
+    # The extension comes from the image itself, so the same picture always gets the same path
+    try:
+        with tempfile.NamedTemporaryFile(dir=UPLOAD_TEMP_FOLDER, suffix='.tmp', delete=False) as temp:
+            cleaned = write_clean_upload(received.name, temp)
+    finally:
+        os.remove(received.name)
+    if cleaned is None:
+        os.remove(temp.name)
+        return None  # Not actually a PNG, JPG or GIF
+    name, extension, animated = cleaned
+    path = f"uploads/{name[:2]}/{name[2:4]}/{name}.{extension}"
+    filepath = os.path.join(app.static_folder, path)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    try:
+        # Already stored: keep that copy, and restart its grace period so cleanup can't
+        # remove it before the row pointing at it is saved
+        os.utime(filepath)
+        os.remove(temp.name)
+    except FileNotFoundError:
+        os.chmod(temp.name, UPLOAD_FILE_MODE)
+        os.replace(temp.name, filepath)
+
+    # Animated GIFs never get resized copies (see make_image_variants), so don't ask again
+    if not animated and not all(
+        os.path.exists(os.path.join(app.static_folder, variant_path(path, size))) for size in IMAGE_VARIANTS
+    ):
+        queue_image_variants(path)
+    return path
+
+
+def remove_upload_files(path):
+    for name in [path] + [variant_path(path, size) for size in IMAGE_VARIANTS]:
+        ready_variants.discard(name)
+        upload_etags.pop(os.path.join(app.static_folder, name), None)
+        try:
+            os.remove(os.path.join(app.static_folder, name))
+        except FileNotFoundError:
+            pass
+
+
+# Call after committing a delete or a flyer change. Triggers keep uploads.refs counting the
+# parties, archived parties and posts that point at each file, so at 0 nothing shows it
+def discard_upload(conn, path):
+    if not path:
+        return False
+    try:
+        if time.time() - os.path.getmtime(os.path.join(app.static_folder, path)) < UPLOAD_GRACE_SECONDS:
+            return False  # May be a duplicate someone is saving right now; gc-uploads gets it later
+    except FileNotFoundError:
+        pass
+    deleted = conn.execute("DELETE FROM uploads WHERE path = ? AND refs <= 0", (path,)).rowcount
+    conn.commit()
+    if deleted:
+        remove_upload_files(path)
+    return bool(deleted)
+
+
+# Removes uploaded files nothing points at any more: flask --app app gc-uploads (e.g. nightly from cron)
+@app.cli.command('gc-uploads')
+@click.option('--dry-run', is_flag=True, help="List what would be removed without removing it")
+def gc_uploads_command(dry_run):
     conn = get_db_connection()
+    # Recount from the tables themselves, so a file is only removed if no row really uses it
+    rebuild_upload_refs(conn)
+    conn.commit()
+    referenced = {row['path'] for row in conn.execute("SELECT path FROM uploads WHERE refs > 0")}
+    keep = referenced | {variant_path(path, size) for path in referenced for size in IMAGE_VARIANTS}
+    cutoff = time.time() - UPLOAD_GRACE_SECONDS
+
+    removed, freed = 0, 0
+    for folder, _, names in os.walk(os.path.join(app.static_folder, 'uploads')):
+        for name in names:
+            filepath = os.path.join(folder, name)
+            path = os.path.relpath(filepath, app.static_folder).replace(os.sep, '/')
+            if path in keep or name.startswith('.') or os.path.getmtime(filepath) > cutoff:
+                continue
+            freed += os.path.getsize(filepath)
+            removed += 1
+            if dry_run:
+                print(path)
+            else:
+                remove_upload_files(path)
+    if not dry_run:
+        conn.execute("DELETE FROM uploads WHERE refs <= 0")
+        conn.commit()
+    conn.close()
+    print(f"{'Would remove' if dry_run else 'Removed'} {removed} unreferenced files ({freed / 1e6:.1f} MB)")
+
+
+# Templates use this to show a resized copy once it exists, and the original until then
+@app.template_global()
+def image_url(path, size='display'):
+    variant = variant_path(path, size)
+    if variant not in ready_variants:
+        if not os.path.exists(os.path.join(app.static_folder, variant)):
+            return upload_url(path)
+        ready_variants.add(variant)
+    return upload_url(variant)
+
+
+# Uploads are served by our own route so they get strong ETags (old /static/uploads links still work)
+UPLOAD_MAX_AGE = 24 * 3600
+upload_etags = {}  # File path -> (mtime, size, etag) so each file is only hashed once
+
+
+def upload_url(path):
+    return url_for('uploaded_file', filename=path.split('/', 1)[1])  # Paths are stored as uploads/<subfolder>/<name>
+
+
+def upload_etag(filepath):
+    stat = os.stat(filepath)
+    cached = upload_etags.get(filepath)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()[:32]
+    upload_etags[filepath] = (stat.st_mtime_ns, stat.st_size, etag)
+    return etag
+
+
+@app.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    filepath = safe_join(os.path.join(app.static_folder, 'uploads'), filename)
+    if filepath is None or not os.path.isfile(filepath):
+        abort(404)
+    # conditional=True answers If-None-Match with a 304 and Range/If-Range with a 206 for partial downloads
+    # A content-addressed file can never change, so browsers can keep it for good
+    immutable = CONTENT_ADDRESSED_UPLOAD.match(filename) is not None
+    response = send_file(filepath, etag=upload_etag(filepath), conditional=True,
+                         max_age=ASSET_MAX_AGE if immutable else UPLOAD_MAX_AGE)
+    response.cache_control.immutable = immutable
+    response.accept_ranges = 'bytes'  # Werkzeug only advertises this on 206s
+    return response
+
+
+# CSS and JS get copied to static/dist with a content hash in the name: flask --app app build-assets
+ASSET_FILES = ('style.css', 'script.js', 'party_detail.js')
+ASSET_FOLDER = 'dist'
+ASSET_MAX_AGE = 365 * 24 * 3600  # A changed file gets a new name, so browsers can keep these for good
+
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(app.static_folder, ASSET_FOLDER, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}  # Not built yet, so templates fall back to the plain static files
+
+
+asset_manifest = load_asset_manifest()  # e.g. 'style.css' -> 'style.3f2a9c1d04be.css'
+
+
+@app.template_global()
+def asset_url(filename):
+    # Debug mode skips the build so edits to static/ show up on refresh
+    if app.debug or filename not in asset_manifest:
+        return url_for('static', filename=filename)
+    return url_for('asset_file', filename=asset_manifest[filename])
+
+
+@app.route('/assets/<path:filename>')
+def asset_file(filename):
+    folder = os.path.join(app.static_folder, ASSET_FOLDER)
+    gzipped = safe_join(folder, filename + '.gz')
+    if wants_gzip() and gzipped and os.path.isfile(gzipped):
+        # Compressed once by build-assets instead of on every request
+        response = send_file(gzipped, mimetype=mimetypes.guess_type(filename)[0], max_age=ASSET_MAX_AGE)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(folder, filename, max_age=ASSET_MAX_AGE)
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def write_file_atomically(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    folder = os.path.join(app.static_folder, ASSET_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    manifest = {}
+    for name in ASSET_FILES:
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            data = f.read()
+        stem, extension = name.rsplit('.', 1)
+        built = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{extension}"
+        write_file_atomically(os.path.join(folder, built), data)
+        # mtime=0 keeps the .gz byte-for-byte the same across builds of the same file
+        write_file_atomically(os.path.join(folder, built + '.gz'), gzip.compress(data, 9, mtime=0))
+        manifest[name] = built
+    write_file_atomically(os.path.join(folder, 'manifest.json'), json.dumps(manifest, indent=2).encode())
+
+    # Drop builds of older versions
+    keep = {'manifest.json'} | set(manifest.values()) | {built + '.gz' for built in manifest.values()}
+    for leftover in set(os.listdir(folder)) - keep:
+        os.remove(os.path.join(folder, leftover))
+    for name, built in manifest.items():
+        print(f"{name} -> {ASSET_FOLDER}/{built}")
+
+
+# Makes resized copies for photos uploaded before variants existed: flask --app app build-image-variants
+@app.cli.command('build-image-variants')
+def build_image_variants_command():
+    conn = get_db_connection()
+    paths = [row[0] for row in conn.execute(
+        "SELECT flyer_path FROM parties WHERE flyer_path IS NOT NULL "
+        "UNION SELECT photo_path FROM posts WHERE photo_path IS NOT NULL"
+    )]
+    conn.close()
+    for path in paths:
+        if os.path.exists(os.path.join(app.static_folder, path)):
+            make_image_variants(path)
+    print(f"Built image variants for {len(paths)} uploads")
+
+# Settings applied once to every new connection to wtm.db
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",         # Readers don't block the writer
+    "PRAGMA synchronous = NORMAL",       # Safe with WAL and far fewer fsyncs
+    "PRAGMA cache_size = -32000",        # ~32MB page cache per connection
+    "PRAGMA mmap_size = 268435456",      # Memory-map up to 256MB of the file
+    "PRAGMA busy_timeout = 5000",        # Wait up to 5s for a lock instead of failing
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that adds its fetch time and row count to the statement's record"""
+
+    query = None
+
+    def _fetch(self, fetch, *args):
+        started = time.perf_counter()
+        result = fetch(*args)
+        if self.query is not None:
+            self.query['duration'] += time.perf_counter() - started
+            self.query['rows'] += len(result) if isinstance(result, list) else result is not None
+        return result
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, size or self.arraysize)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool"""
+
+    pool = None
+    request_bound = False
+
+    # Every statement run during a request is timed - see record_query
+    def execute(self, sql, parameters=()):
+        cursor = self.cursor(TimedCursor)
+        started = time.perf_counter()
+        cursor.execute(sql, parameters)
+        cursor.query = record_query(sql, parameters, time.perf_counter() - started, cursor.rowcount)
+        return cursor
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        cursor = super().executemany(sql, seq_of_parameters)
+        record_query(sql, None, time.perf_counter() - started, cursor.rowcount)
+        return cursor
+
+    def close(self):
+        # Connections handed out through flask.g are released at teardown
+        if self.request_bound:
+            return
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def close_for_real(self):
+        super().close()
+
+
+class ConnectionPool:
+    """Keeps a small stack of configured connections to reuse across requests"""
+
+    def __init__(self, database, max_size=DB_POOL_SIZE):
+        self.database = database
+        self.max_size = max_size
+        self._idle = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, factory=PooledConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self.misses += 1
+        return self._connect()
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close_for_real()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'idle': len(self._idle), 'max_size': self.max_size}
+
+
+db_pool = ConnectionPool(DATABASE)
+
+
+# Connect to wtm.db - one pooled connection is shared by everything in a request
+def get_db_connection():
+    if not has_app_context():
+        return db_pool.acquire()
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+        g.db.request_bound = True
+    return g.db
+
+
+# Give the request's connection back to the pool once the response is done
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.request_bound = False
+        db_pool.release(conn)
+
+
+# Request instrumentation - every statement on the request's connection is recorded in
+# g.queries (SQL, parameters, seconds, rows) along with time spent in render_template
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Set on the writer thread while it runs one request's operation (see DatabaseWriter._commit)
+writer_queries = threading.local()
+
+
+def record_query(sql, parameters, duration, rowcount):
+    queries = getattr(writer_queries, 'queries', None)
+    if queries is None:
+        if not has_request_context() or 'queries' not in g:
+            return None  # CLI commands and background threads aren't measured
+        queries = g.queries
+    query = {'sql': sql, 'parameters': parameters, 'duration': duration, 'rows': max(rowcount, 0)}
+    queries.append(query)
+    return query
+
+
+# Literals and IN-lists become ? so the same statement groups together
+def normalize_sql(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', 'IN (?, ...)', sql, flags=re.IGNORECASE)
+    return ' '.join(sql.split())
+
+
+def log_slow_query(conn, query, sql):
+    plan = ''
+    if query['parameters'] is not None:
+        try:
+            # Plain sqlite3 execute, so the plan lookup isn't recorded itself
+            rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + query['sql'], query['parameters'])
+            plan = '\n'.join('    ' + row[-1] for row in rows)
+        except sqlite3.Error:
+            pass
+    app.logger.warning("Slow query on %s (%.1f ms, %d rows): %s\n%s",
+                       request.path, query['duration'] * 1000, query['rows'], sql, plan)
+
+
+class Histogram:
+    """Prometheus-style histogram with one series per label value"""
+
+    def __init__(self, name, help_text, label, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            counts = self.series.setdefault(label_value, [[0] * len(self.buckets), 0, 0.0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][index] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, (buckets, count, total) in sorted(self.series.items(), key=lambda item: str(item[0])):
+                # A histogram without a label keeps a single series under None
+                labels = f'{self.label}="{metric_label(label_value)}"' if self.label else ''
+                bucket_labels = labels + ',' if labels else ''
+                for bound, bucket_count in zip(self.buckets, buckets):
+                    lines.append(f'{self.name}_bucket{{{bucket_labels}le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{bucket_labels}le="+Inf"}} {count}')
+                suffix = f'{{{labels}}}' if labels else ''
+                lines.append(f'{self.name}_sum{suffix} {total}')
+                lines.append(f'{self.name}_count{suffix} {count}')
+        return lines
+
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_seconds = Histogram('wtm_request_duration_seconds', "Time to handle a request", 'route')
+request_db_seconds = Histogram('wtm_request_db_seconds', "Time spent running SQL per request", 'route')
+request_template_seconds = Histogram('wtm_request_template_seconds', "Time spent in render_template per request", 'route')
+request_queries = Histogram('wtm_request_queries', "SQL statements per request", 'route',
+                            buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+# Calls and seconds per normalized statement, to find the expensive ones
+statement_totals = collections.defaultdict(lambda: [0, 0.0])
+statement_totals_lock = threading.Lock()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.queries = []
+    g.template_seconds = 0.0
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.template_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+    if 'template_started' in g:
+        g.template_seconds += time.perf_counter() - g.pop('template_started')
+
+
+# Shows up under "Timing" in the browser's network panel
+@app.after_request
+def add_server_timing(response):
+    if 'queries' in g:
+        db_ms = sum(query['duration'] for query in g.queries) * 1000
+        response.headers['Server-Timing'] = (
+            f'db;dur={db_ms:.2f};desc="{len(g.queries)} queries", tpl;dur={g.template_seconds * 1000:.2f}'
+        )
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exception=None):
+    if 'request_started' not in g:
+        return
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    queries = g.pop('queries')
+    request_seconds.observe(route, time.perf_counter() - g.pop('request_started'))
+    request_db_seconds.observe(route, sum(query['duration'] for query in queries))
+    request_template_seconds.observe(route, g.template_seconds)
+    request_queries.observe(route, len(queries))
+
+    for query in queries:
+        sql = normalize_sql(query['sql'])
+        with statement_totals_lock:
+            totals = statement_totals[sql]
+            totals[0] += 1
+            totals[1] += query['duration']
+        if query['duration'] * 1000 >= SLOW_QUERY_MS and 'db' in g:
+            log_slow_query(g.db, query, sql)
+
+
+# Turns the form's date and time into one sortable "YYYY-MM-DD HH:MM:SS" value
+def make_starts_at(date, time):
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(f"{date} {time}", fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+# Schema migrations - each one runs exactly once, in order, and is recorded in schema_version.
+# Run them with: flask --app app migrate (startup also runs them under a file lock if needed)
+def add_column_if_missing(conn, table, column, definition):
+    columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+# Recounts every post's comments from scratch (also used if the counters ever drift)
+def rebuild_comment_counts(conn):
+    conn.execute(
+        "UPDATE posts SET comment_count = (SELECT COUNT(*) FROM comments c WHERE c.post_id = posts.id)"
+    )
+
+
+# Every column that can point at a file in static/uploads
+UPLOAD_REFERENCES = (('parties', 'flyer_path'), ('parties_archive', 'flyer_path'), ('posts', 'photo_path'))
+
+
+def rebuild_upload_refs(conn):
+    references = " UNION ALL ".join(
+        f"SELECT {column} AS path FROM {table} WHERE {column} IS NOT NULL" for table, column in UPLOAD_REFERENCES
+    )
+    conn.execute("UPDATE uploads SET refs = 0")
+    conn.execute(
+        f"INSERT INTO uploads (path, refs) SELECT path, COUNT(*) FROM ({references}) WHERE true GROUP BY path "
+        "ON CONFLICT(path) DO UPDATE SET refs = excluded.refs"
+    )
+
+
+# This creates our users, parties, wishlist, posts and comments tables
+def migration_base_tables(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+            username TEXT NOT NULL,
+            hash TEXT NOT NULL
+        );
+        """
+    )
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS parties (
@@ -50,11 +739,612 @@ def init_db():
         );
         """
     )
-    conn.commit()
-    conn.close()   # Closes the query after commiting
+    # Users can save parties to their wishlist
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wishlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            party_id INTEGER NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (party_id) REFERENCES parties(id) ON DELETE CASCADE,
+            UNIQUE(user_id, party_id)
+        );
+        """
+    )
+    # Posts and comments for the live feed
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+        """
+    )
+
+
+# Usernames, map coordinates and photo uploads were added after the first version
+def migration_profile_map_and_photo_columns(conn):
+    add_column_if_missing(conn, 'users', 'display_name', 'TEXT')
+    add_column_if_missing(conn, 'parties', 'latitude', 'REAL')
+    add_column_if_missing(conn, 'parties', 'longitude', 'REAL')
+    add_column_if_missing(conn, 'parties', 'flyer_path', 'TEXT')
+    add_column_if_missing(conn, 'posts', 'photo_path', 'TEXT')
+
+
+# Adds an indexed starts_at column so upcoming-party queries can use a range scan
+def migration_parties_starts_at(conn):
+    add_column_if_missing(conn, 'parties', 'starts_at', 'TEXT')
+    # Backfill rows created before the column existed (same format as datetime())
+    conn.execute(
+        "UPDATE parties SET starts_at = datetime(date || ' ' || time) WHERE starts_at IS NULL"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_parties_starts_at ON parties(starts_at)")
+
+
+# Keeps a version number per kind of data so cached responses know when they are stale
+def migration_data_versions(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+
+
+# Indexes so the feed can page by (created_at, id) and count comments per post
+def migration_feed_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts(created_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_id ON comments(post_id)")
+
 
+# Keeps a comment_count on each post so the feed doesn't have to count comments
+def migration_post_comment_counts(conn):
+    add_column_if_missing(conn, 'posts', 'comment_count', 'INTEGER NOT NULL DEFAULT 0')
+    rebuild_comment_counts(conn)  # Fill in counts for posts that already have comments
+
+    # Triggers keep the count right whenever a comment is added or deleted
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS comments_count_insert AFTER INSERT ON comments
+        BEGIN
+            UPDATE posts SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS comments_count_delete AFTER DELETE ON comments
+        BEGIN
+            UPDATE posts SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+        END;
+        """
+    )
+
+
+# R*Tree spatial index over party coordinates so the map only reads parties in view
+def migration_party_locations_index(conn):
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS party_locations USING rtree(id, min_lat, max_lat, min_lng, max_lng)"
+    )
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO party_locations
+        SELECT id, latitude, latitude, longitude, longitude
+        FROM parties
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        """
+    )
+
+    # Triggers keep the index in sync with add, edit (and re-geocode) and delete
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS party_locations_insert AFTER INSERT ON parties
+        WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+        BEGIN
+            INSERT INTO party_locations VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS party_locations_update AFTER UPDATE OF latitude, longitude ON parties
+        BEGIN
+            DELETE FROM party_locations WHERE id = OLD.id;
+            INSERT INTO party_locations
+            SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS party_locations_delete AFTER DELETE ON parties
+        BEGIN
+            DELETE FROM party_locations WHERE id = OLD.id;
+        END;
+        """
+    )
+
+
+# FTS5 full-text indexes for search, kept in sync with triggers
+SEARCH_INDEXES = {
+    'parties_fts': ('parties', ['party_name', 'location', 'description', 'host_name']),
+    'posts_fts': ('posts', ['content']),
+    'comments_fts': ('comments', ['content']),
+}
+
+
+def migration_search_indexes(conn):
+    for index, (table, columns) in SEARCH_INDEXES.items():
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f"NEW.{column}" for column in columns)
+        old_values = ', '.join(f"OLD.{column}" for column in columns)
+        # External-content tables store only the index; the text stays in the real table
+        conn.execute(
+            f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5(
+                {column_list}, content='{table}', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+            """
+        )
+        conn.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {index}(rowid, {column_list}) VALUES (NEW.id, {new_values});
+            END;
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO {index}({index}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+            END;
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {column_list} ON {table}
+            BEGIN
+                INSERT INTO {index}({index}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+                INSERT INTO {index}(rowid, {column_list}) VALUES (NEW.id, {new_values});
+            END;
+            """
+        )
+
+
+# Shared event log so feed events reach browsers connected to other worker processes
+def migration_feed_events(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS feed_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+
+
+# Comments are paged by (created_at, id) within a post; this index covers post_id lookups too
+def migration_comments_page_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_created ON comments(post_id, created_at, id)")
+    conn.execute("DROP INDEX IF EXISTS idx_comments_post_id")
+
+
+# Past parties are moved here by the archive job (see archive_old_parties)
+def migration_party_archive(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS parties_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            host_name TEXT NOT NULL,
+            party_name TEXT NOT NULL,
+            location TEXT NOT NULL,
+            latitude REAL,
+            longitude REAL,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            starts_at TEXT,
+            description TEXT,
+            flyer_path TEXT,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_parties_archive_starts_at ON parties_archive(starts_at)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wishlist_archive (
+            user_id INTEGER NOT NULL,
+            party_id INTEGER NOT NULL,
+            added_at TIMESTAMP,
+            PRIMARY KEY (user_id, party_id)
+        );
+        """
+    )
+
+
+# Reference counts for uploaded files so deleting the last party or post using one can remove it
+def migration_upload_refs(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS uploads (
+            path TEXT PRIMARY KEY,
+            refs INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+    rebuild_upload_refs(conn)
+
+    for table, column in UPLOAD_REFERENCES:
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_uploads_insert AFTER INSERT ON {table}
+            WHEN NEW.{column} IS NOT NULL
+            BEGIN
+                INSERT INTO uploads (path, refs) VALUES (NEW.{column}, 1)
+                ON CONFLICT(path) DO UPDATE SET refs = refs + 1;
+            END;
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_uploads_delete AFTER DELETE ON {table}
+            WHEN OLD.{column} IS NOT NULL
+            BEGIN
+                UPDATE uploads SET refs = refs - 1 WHERE path = OLD.{column};
+            END;
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_uploads_update AFTER UPDATE OF {column} ON {table}
+            WHEN OLD.{column} IS NOT NEW.{column}
+            BEGIN
+                UPDATE uploads SET refs = refs - 1 WHERE path = OLD.{column};
+                INSERT INTO uploads (path, refs) SELECT NEW.{column}, 1 WHERE NEW.{column} IS NOT NULL
+                ON CONFLICT(path) DO UPDATE SET refs = refs + 1;
+            END;
+            """
+        )
+
+
+# Add new migrations to the end of this list - never reorder or edit ones that have shipped
+MIGRATIONS = [
+    (1, migration_base_tables),
+    (2, migration_profile_map_and_photo_columns),
+    (3, migration_parties_starts_at),
+    (4, migration_data_versions),
+    (5, migration_feed_indexes),
+    (6, migration_post_comment_counts),
+    (7, migration_party_locations_index),
+    (8, migration_search_indexes),
+    (9, migration_feed_events),
+    (10, migration_comments_page_index),
+    (11, migration_party_archive),
+    (12, migration_upload_refs),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    try:
+        return conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return 0  # No schema_version table yet
+
+
+def run_migrations(conn):
+    """Applies every migration newer than the database, each in its own transaction"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    applied = []
+    for version, migration in MIGRATIONS:
+        if version <= get_schema_version(conn):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration(conn)
+            conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+# Normal startup is a single version check; only an out-of-date database takes the lock
+def ensure_schema():
+    conn = get_db_connection()
+    try:
+        if get_schema_version(conn) >= LATEST_SCHEMA_VERSION:
+            return
+        # The lock file stops several workers from migrating at the same time
+        with open(DATABASE + '.migrate.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            run_migrations(conn)
+    finally:
+        conn.close()
+
+
+# Command to upgrade the database: flask --app app migrate
+@app.cli.command('migrate')
+def migrate_command():
+    conn = get_db_connection()
+    applied = run_migrations(conn)
+    conn.close()
+    if applied:
+        print(f"Applied migrations {applied}; schema is at version {LATEST_SCHEMA_VERSION}")
+    else:
+        print(f"Schema already at version {LATEST_SCHEMA_VERSION}")
+
+
+ensure_schema()
+
+
+# Call inside the same transaction as the write so every worker sees the new version
+def bump_data_version(conn, name):
+    conn.execute(
+        """
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+        """,
+        (name,),
+    )
+
+
+def get_data_version(conn, name):
+    row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    return row['version'] if row else 0
+
+
+# All the hot write routes go through one writer thread. It takes whatever writes are
+# queued, runs them in a single transaction (each inside its own savepoint, so one
+# failing write doesn't undo the others) and commits once for the whole batch
+WRITE_BATCH_LIMIT = int(os.environ.get('WRITE_BATCH_LIMIT', 64))
+WRITE_QUEUE_LIMIT = int(os.environ.get('WRITE_QUEUE_LIMIT', 1000))
+WRITE_QUEUE_TIMEOUT = 5  # Seconds a request waits for room in a full queue
+WRITE_RETRY_AFTER = 2
+
+
+class WriteQueueFull(Exception):
+    """Raised when the writer thread is too far behind to take more writes"""
+
+
+class DatabaseWriter:
+    """Single writer thread that commits queued writes in batches"""
+
+    def __init__(self, pool, batch_limit=WRITE_BATCH_LIMIT, queue_limit=WRITE_QUEUE_LIMIT):
+        self.pool = pool
+        self.batch_limit = batch_limit
+        self.queue = queue.Queue(queue_limit)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+        self.batch_sizes = Histogram('wtm_db_write_batch_size', "Writes committed together", None,
+                                     buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+        self.wait_seconds = Histogram('wtm_db_write_wait_seconds', "Time a write waited in the queue", None)
+
+    def _start(self):
+        # Started on first use, so CLI commands and forked workers each get their own
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def run(self, operation):
+        """Runs operation(conn) in the next batch and returns its result (or raises its error).
+        operation must not commit or close the connection"""
+        self._start()
+        future = Future()
+        try:
+            self.queue.put((operation, future, time.perf_counter()), timeout=WRITE_QUEUE_TIMEOUT)
+        except queue.Full:
+            raise WriteQueueFull()
+        result, queries = future.result()
+        # The statements ran on the writer thread, so count them toward this request here
+        if has_request_context() and 'queries' in g:
+            g.queries.extend(queries)
+        return result
+
+    def _run(self):
+        conn = self.pool.acquire()
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_limit:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(conn, batch)
+
+    def _commit(self, conn, batch):
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for operation, future, queued_at in batch:
+                self.wait_seconds.observe(None, started - queued_at)
+                conn.execute("SAVEPOINT write")
+                writer_queries.queries = []
+                try:
+                    outcomes.append((future, (operation(conn), writer_queries.queries), None))
+                except Exception as error:
+                    conn.execute("ROLLBACK TO write")
+                    outcomes.append((future, None, error))
+                finally:
+                    writer_queries.queries = None
+                conn.execute("RELEASE write")
+            conn.commit()
+        except Exception as error:
+            # Nothing in the batch was saved, so every waiting request gets the error
+            if conn.in_transaction:
+                conn.rollback()
+            outcomes = [(future, None, error) for _, future, _ in batch]
+
+        with self._lock:
+            self.batches += 1
+            self.writes += len(batch)
+            self.failed += sum(1 for _, _, error in outcomes if error is not None)
+        self.batch_sizes.observe(None, len(batch))
+        # Only answer once the commit is done, so a redirect always sees the new row
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'batches': self.batches,
+                'writes': self.writes,
+                'failed': self.failed,
+            }
+
+
+db_writer = DatabaseWriter(db_pool)
+
+
+@app.errorhandler(WriteQueueFull)
+def writes_busy(error):
+    response = jsonify({'error': 'Too many updates right now, please try again in a moment.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(WRITE_RETRY_AFTER)
+    return response
+
+
+# Fragment cache for template blocks that rarely change - wrap them in
+# {% cache 'name', data_version('parties'), ... %}...{% endcache %}. Every argument
+# after the name goes into the key, so bumping a data version (or a per-user value
+# like wishlist state) makes a fresh entry and the old one ages out of the LRU
+FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES', 8 * 1024 * 1024))
+
+
+class FragmentCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.counts = collections.defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self.lock = threading.Lock()
+
+    def get_or_render(self, name, key, render):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+                self.counts[name]['hits'] += 1
+                return html
+            self.counts[name]['misses'] += 1
+
+        html = render()
+        if len(html) > self.max_bytes:
+            return html  # Too big to be worth keeping
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = html
+                self.size += len(html)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return html
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'fragments': {name: dict(counts) for name, counts in self.counts.items()},
+            }
+
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the {% cache name, key... %} block tag"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        name = str(args[0])
+        # Keys can hold long id lists, so store a digest instead
+        digest = hashlib.sha1('\x1f'.join(str(arg) for arg in args).encode()).hexdigest()
+        return Markup(fragment_cache.get_or_render(name, digest, lambda: str(caller())))
+
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+
+# Versions are read once per request so several fragments share the lookups
+@app.template_global()
+def data_version(name):
+    versions = g.setdefault('data_versions', {})
+    if name not in versions:
+        conn = get_db_connection()
+        versions[name] = get_data_version(conn, name)
+        conn.close()
+    return versions[name]
+
+
+# Hit/miss counts per fragment, to see which blocks are worth caching
+@app.route('/api/fragment-cache')
+def fragment_cache_stats():
+    return jsonify(fragment_cache.stats())
 
-init_db()
 
 # Keeps the current user in session
 def current_user():
@@ -63,6 +1353,90 @@ def current_user():
     return None
 
 
+# Profile rows (display name, email) cached per user so page headers don't query users on
+# every request. Invalidation only reaches this process, so the host check reads the table
+PROFILE_CACHE_USERS = int(os.environ.get('PROFILE_CACHE_USERS', 10000))
+PROFILE_CACHE_TTL = 300  # Seconds; also bounds staleness if an invalidation is ever missed
+
+
+class LocalInvalidationChannel:
+    """Delivers cache invalidations to listeners in this process. A multi-process
+    deployment swaps in a channel with the same publish()/subscribe() over a shared bus"""
+
+    def __init__(self):
+        self._listeners = []
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def publish(self, topic, key):
+        for listener in self._listeners:
+            listener(topic, key)
+
+
+invalidation_channel = LocalInvalidationChannel()
+
+
+class ProfileCache:
+    """LRU of user_id -> {'id', 'email', 'display_name'} with a TTL"""
+
+    def __init__(self, max_users, ttl, channel):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.channel = channel
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        channel.subscribe(self._on_invalidate)
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        conn = get_db_connection()
+        row = conn.execute("SELECT id, username, display_name FROM users WHERE id = ?", (user_id,)).fetchone()
+        conn.close()
+        if row is None:
+            return None
+        profile = {'id': row['id'], 'email': row['username'], 'display_name': row['display_name']}
+        with self._lock:
+            self._entries[user_id] = (now, profile)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return profile
+
+    def invalidate(self, user_id):
+        # Goes through the channel so every process drops its copy, including this one
+        self.channel.publish('profile', user_id)
+
+    def _on_invalidate(self, topic, user_id):
+        if topic == 'profile':
+            with self._lock:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'users': len(self._entries)}
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_USERS, PROFILE_CACHE_TTL, invalidation_channel)
+
+
+# The signed-in user's profile for page headers (None when signed out)
+@app.template_global()
+def current_profile():
+    user = current_user()
+    return profile_cache.get(user['id']) if user else None
+
+
 # Shows upcoming parties on the homescreen of the front page
 def get_upcoming_parties(limit=3):
     conn = get_db_connection()
@@ -79,8 +1453,8 @@ def get_upcoming_parties(limit=3):
                u.username AS created_by
         FROM parties p
         JOIN users u ON p.user_id = u.id
-        WHERE datetime(p.date || ' ' || p.time) >= datetime('now', 'localtime')
-        ORDER BY datetime(p.date || ' ' || p.time)
+        WHERE p.starts_at >= datetime('now', 'localtime')
+        ORDER BY p.starts_at
         LIMIT ?
         """,
         (limit,),
@@ -122,10 +1496,23 @@ def party_detail(party_id):
         """,
         (party_id,),
     ).fetchone()
+    archived = False
+    if not party:
+        # Links from the history page point at parties that have been archived
+        party = conn.execute(
+            """
+            SELECT a.*, u.username AS created_by, u.display_name AS verified_host
+            FROM parties_archive a
+            JOIN users u ON a.user_id = u.id
+            WHERE a.id = ?
+            """,
+            (party_id,),
+        ).fetchone()
+        archived = True
     conn.close()
     if not party:
         return redirect(url_for('list_page'))
-    return render_template('party_detail.html', party=party)
+    return render_template('party_detail.html', party=party, archived=archived)
 
 
 # WTM Harvard's "About" page
@@ -134,6 +1521,117 @@ def about():
     return render_template('about.html')
 
 
+# Password hashing runs in its own processes so a burst of logins can't starve every other route
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 2))
+HASH_QUEUE_LIMIT = int(os.environ.get('HASH_QUEUE_LIMIT', 16))  # Hashes running or waiting at once
+HASH_RETRY_AFTER = 2  # Seconds we ask clients to wait when the queue is full
+
+
+class HashQueueFull(Exception):
+    """Raised when too many password hashes are already waiting"""
+
+
+class PasswordHasher:
+    """Fixed-size process pool for password hashing with a bounded queue in front of it"""
+
+    def __init__(self, workers, queue_limit):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def _pool(self):
+        # Started on first use so importing app.py doesn't spawn processes
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashQueueFull()
+
+        started = time.perf_counter()
+        with self._lock:
+            self.queue_depth += 1
+        try:
+            for attempt in range(2):
+                executor = self._pool()
+                try:
+                    return executor.submit(func, *args).result()
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed for memory), which breaks the whole pool for good,
+                    # so start a fresh one and try once more before telling the client to retry
+                    app.logger.warning("Password hashing pool broke, starting a new one")
+                    self._discard(executor)
+            raise HashQueueFull()
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.queue_depth -= 1
+                self.completed += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+            self._slots.release()
+
+    def _discard(self, executor):
+        with self._lock:
+            # Another request may already have replaced it
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+    def check(self, stored_hash, password):
+        return self.run(check_password_hash, stored_hash, password)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_seconds': self.total_seconds / self.completed if self.completed else 0.0,
+                'max_seconds': self.max_seconds,
+            }
+
+
+password_hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_LIMIT)
+
+
+# Hashes made with older settings (e.g. fewer iterations) get upgraded the next time the user logs in
+def needs_rehash(stored_hash):
+    return stored_hash.split('$', 1)[0] != PASSWORD_HASH_METHOD
+
+
+# Fast "try again shortly" page for when the hashing queue is full
+def hashing_busy(template):
+    response = app.make_response((
+        render_template(template, error="Lots of people are signing in right now. Please try again in a moment."),
+        503,
+    ))
+    response.headers['Retry-After'] = str(HASH_RETRY_AFTER)
+    return response
+
+
 # Creates the login-page
 @app.route('/login')
 def login_page():
@@ -153,7 +1651,21 @@ def login_submit():
     user = conn.execute("SELECT * FROM users WHERE username = ?", (email,)).fetchone()
     conn.close()
 
-    if user and check_password_hash(user["hash"], password):
+    try:
+        valid = user is not None and password_hasher.check(user["hash"], password)
+    except HashQueueFull:
+        return hashing_busy('login.html')
+
+    if valid:
+        # Upgrade the stored hash to the current settings (tried again next login if we're busy)
+        if needs_rehash(user["hash"]):
+            try:
+                conn = get_db_connection()
+                conn.execute("UPDATE users SET hash = ? WHERE id = ?", (password_hasher.hash(password), user["id"]))
+                conn.commit()
+                conn.close()
+            except HashQueueFull:
+                pass
         session['user'] = email
         session['user_id'] = user["id"]
         session['username'] = user["display_name"]  # Stores the username in the user's session
@@ -200,18 +1712,33 @@ def register_submit():
         conn.close()
         return render_template('register.html', error="That username is already taken. Please choose another.")
 
-    hashed_password = generate_password_hash(password)
+    conn.close()
+
+    try:
+        hashed_password = password_hasher.hash(password)
+    except HashQueueFull:
+        return hashing_busy('register.html')
     
     # Allows username to be diplayed instead of email
-    cursor = conn.execute(
-        "INSERT INTO users (username, hash, display_name) VALUES (?, ?, ?)", 
-        (email, hashed_password, username)
-    )
-    conn.commit()
+    def insert_user(conn):
+        # Checked again here since someone may have signed up while we were hashing
+        taken = conn.execute(
+            "SELECT 1 FROM users WHERE username = ? OR display_name = ?", (email, username)
+        ).fetchone()
+        if taken:
+            return None
+        cursor = conn.execute(
+            "INSERT INTO users (username, hash, display_name) VALUES (?, ?, ?)", 
+            (email, hashed_password, username)
+        )
+        return cursor.lastrowid
+
+    user_id = db_writer.run(insert_user)
+    if user_id is None:
+        return render_template('register.html', error="That email or username was just taken. Please choose another.")
     session['user'] = email
-    session['user_id'] = cursor.lastrowid  # Adds user's information to wtm.db
+    session['user_id'] = user_id  # Adds user's information to wtm.db
     session['username'] = username  
-    conn.close()
 
     return redirect(url_for('index'))
 
@@ -246,14 +1773,234 @@ HARVARD_SQUARE_LOCATIONS = {
     'currier house': (42.3818, -71.1251),
 }
 
+# Other names people use for the places above
+HARVARD_LOCATION_ALIASES = {
+    'the square': 'harvard square',
+    'the yard': 'harvard yard',
+    'widener': 'widener library',
+    'mem hall': 'memorial hall',
+    'sci center': 'science center',
+    'annenberg hall': 'annenberg',
+    'pfoho': 'pforzheimer house',
+}
+
+DEFAULT_COORDINATES = HARVARD_SQUARE_LOCATIONS['harvard square']
+
+
+def tokenize_location(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+class LocationMatcher:
+    """Word trie over every place name, built once so lookups don't scan the whole list"""
+
+    def __init__(self, locations, aliases):
+        self.root = {}
+        for name, coords in locations.items():
+            self.add(name, coords)
+        for alias, name in aliases.items():
+            self.add(alias, locations[name])
+
+    def add(self, name, coords):
+        node = self.root
+        for token in tokenize_location(name):
+            node = node.setdefault(token, {})
+        node[None] = coords  # None marks the end of a full place name
+
+    def match(self, text):
+        """Returns the coordinates of the longest place name in text (leftmost wins ties)"""
+        tokens = tokenize_location(text)
+        best, best_length = None, 0
+        for start in range(len(tokens)):
+            node = self.root
+            for end in range(start, len(tokens)):
+                node = node.get(tokens[end])
+                if node is None:
+                    break
+                if None in node and end - start + 1 > best_length:
+                    best, best_length = node[None], end - start + 1
+        return best
+
+
+location_matcher = LocationMatcher(HARVARD_SQUARE_LOCATIONS, HARVARD_LOCATION_ALIASES)
+
+
+@functools.lru_cache(maxsize=2048)
 def geocode_location(location):
     """Simple geocoding for Harvard locations"""
-    location_lower = location.lower().strip()
-    for key, coords in HARVARD_SQUARE_LOCATIONS.items():
-        if key in location_lower:
-            return coords
+    coords = location_matcher.match(location)
     # Default to Harvard Square if location not found
-    return (42.3736, -71.1190)
+    return coords or DEFAULT_COORDINATES
+
+
+# Re-runs geocoding over every party: flask --app app regeocode-parties
+@app.cli.command('regeocode-parties')
+def regeocode_parties_command():
+    conn = get_db_connection()
+    updates = []
+    for party in conn.execute("SELECT id, location, latitude, longitude FROM parties"):
+        latitude, longitude = geocode_location(party['location'])
+        if (party['latitude'], party['longitude']) != (latitude, longitude):
+            updates.append((latitude, longitude, party['id']))
+
+    conn.executemany("UPDATE parties SET latitude = ?, longitude = ? WHERE id = ?", updates)
+    if updates:
+        bump_data_version(conn, 'parties')
+    conn.commit()
+    conn.close()
+    print(f"Updated coordinates for {len(updates)} parties")
+
+
+# Bulk loading parties, e.g. for orientation week: flask --app app import-parties parties.csv
+# Rows need the same fields as the /add form (host_name must be an existing user's username).
+# The file is read a chunk at a time, so memory stays flat however big it is
+IMPORT_BATCH_SIZE = 500
+IMPORT_FIELDS = ('host_name', 'party_name', 'location', 'date', 'time')
+EXPORT_QUERIES = {
+    'parties': "SELECT id, user_id, host_name, party_name, location, latitude, longitude, date, time, "
+               "starts_at, description, flyer_path, created_at FROM parties ORDER BY id",
+    'posts': "SELECT id, user_id, content, photo_path, comment_count, created_at FROM posts ORDER BY id",
+    'wishlist': "SELECT id, user_id, party_id, added_at FROM wishlist ORDER BY id",
+}
+
+
+def read_import_rows(file, file_format):
+    """Yields (line number, row dict or None if the line isn't valid JSON)"""
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def validate_party_row(row):
+    """Returns the cleaned row, or the reason it can't be imported"""
+    if row is None:
+        return None, "Not a JSON object"
+    party = {field: str(row.get(field) or '').strip() for field in IMPORT_FIELDS}
+    missing = [field for field in IMPORT_FIELDS if not party[field]]
+    if missing:
+        return None, f"Missing {', '.join(missing)}"
+    party['starts_at'] = make_starts_at(party['date'], party['time'])
+    if party['starts_at'] is None:
+        return None, "Date must be YYYY-MM-DD and time HH:MM"
+    party['description'] = str(row.get('description') or '').strip()
+    return party, None
+
+
+def find_hosts(conn, host_names, hosts):
+    """Fills hosts (lowercase username -> user id) for any names it doesn't have yet"""
+    wanted = {name.lower() for name in host_names} - hosts.keys()
+    if wanted:
+        placeholders = ','.join('?' * len(wanted))
+        for row in conn.execute(
+            f"SELECT id, lower(display_name) AS name FROM users WHERE lower(display_name) IN ({placeholders})",
+            tuple(wanted),
+        ):
+            hosts[row['name']] = row['id']
+        for name in wanted - hosts.keys():
+            hosts[name] = None  # Remember misses too so they aren't looked up again
+
+
+def insert_party_batch(conn, parties):
+    conn.executemany(
+        """
+        INSERT INTO parties (user_id, host_name, party_name, location, latitude, longitude, date, time, starts_at, description)
+        VALUES (:user_id, :host_name, :party_name, :location, :latitude, :longitude, :date, :time, :starts_at, :description)
+        """,
+        parties,
+    )
+    bump_data_version(conn, 'parties')
+    return len(parties)
+
+
+@app.cli.command('import-parties')
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']),
+              help="Defaults to the file extension (.jsonl, otherwise csv)")
+@click.option('--rejects', type=click.File('w'), help="Write rejected rows here as CSV (line, reason, row)")
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+@click.option('--dry-run', is_flag=True, help="Validate every row without inserting anything")
+def import_parties_command(source, file_format, rejects, batch_size, dry_run):
+    file_format = file_format or ('jsonl' if source.name.endswith(('.jsonl', '.ndjson')) else 'csv')
+    reject_writer = csv.writer(rejects) if rejects else None
+    if reject_writer:
+        reject_writer.writerow(['line', 'reason', 'row'])
+
+    conn = get_db_connection()
+    hosts = {}
+    imported = rejected = 0
+    rows = read_import_rows(source, file_format)
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk:
+            break
+
+        valid = []
+        for line_number, row in chunk:
+            party, reason = validate_party_row(row)
+            if party:
+                valid.append((line_number, row, party))
+                continue
+            rejected += 1
+            if reject_writer:
+                reject_writer.writerow([line_number, reason, json.dumps(row)])
+
+        # One users lookup and one geocode per distinct host/location in the chunk
+        find_hosts(conn, {party['host_name'] for _, _, party in valid}, hosts)
+        coordinates = {location: geocode_location(location) for location in {party['location'] for _, _, party in valid}}
+        batch = []
+        for line_number, row, party in valid:
+            party['user_id'] = hosts[party['host_name'].lower()]
+            if party['user_id'] is None:
+                rejected += 1
+                if reject_writer:
+                    reject_writer.writerow([line_number, f"No user named {party['host_name']}", json.dumps(row)])
+                continue
+            party['latitude'], party['longitude'] = coordinates[party['location']]
+            batch.append(party)
+
+        # Each chunk is its own transaction on the writer queue, like the archive job
+        if batch and not dry_run:
+            imported += db_writer.run(lambda conn: insert_party_batch(conn, batch))
+        elif dry_run:
+            imported += len(batch)
+
+    conn.close()
+    print(f"{'Would import' if dry_run else 'Imported'} {imported} parties, rejected {rejected} rows")
+
+
+# Streams a whole table out for backups or analysis: flask --app app export-data parties -o parties.csv
+@app.cli.command('export-data')
+@click.argument('table', type=click.Choice(sorted(EXPORT_QUERIES)))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default='jsonl', show_default=True)
+@click.option('--output', '-o', type=click.File('w'), default='-', help="Defaults to stdout")
+def export_data_command(table, file_format, output):
+    conn = get_db_connection()
+    cursor = conn.execute(EXPORT_QUERIES[table])
+    columns = [column[0] for column in cursor.description]
+    writer = csv.writer(output) if file_format == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    count = 0
+    # fetchmany keeps only one block of rows in memory at a time
+    for rows in iter(lambda: cursor.fetchmany(IMPORT_BATCH_SIZE), []):
+        for row in rows:
+            if writer:
+                writer.writerow(row)
+            else:
+                output.write(json.dumps(dict(zip(columns, row))) + '\n')
+        count += len(rows)
+    conn.close()
+    click.echo(f"Exported {count} rows from {table}", err=True)
 
 
 # Allows user to add party and party details
@@ -275,43 +2022,41 @@ def add_party():
 
     if not all([host_name, party_name, location, date, time]):
         return render_template('add.html', user=user, error="All fields except description are required.")
+
+    # Parties without a start time would never show up in the list, map or history
+    starts_at = make_starts_at(date, time)
+    if starts_at is None:
+        return render_template('add.html', user=user, error="Date must be YYYY-MM-DD and time HH:MM.")
     
     # This is the Security Feature to verify host name matches users display name - S
 
+    # Read from the database, not profile_cache: a rename on another worker must count here right away
     conn = get_db_connection()
     #S 
     user_data = conn.execute("SELECT display_name FROM users WHERE id = ?", (user['id'],)).fetchone()
+    conn.close()
     
     if user_data['display_name'].lower() != host_name.lower():
-        conn.close()
         return render_template('add.html', user=user, 
                              error=f"Host name must match your username ({user_data['display_name']}) to verify you are the actual host.")
     
     # Handle the flyer upload - S
-    flyer_path = None 
-    if 'flyer' in request.files:
-        file = request.files['flyer']
-        if file and file.filename != '' and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            # Create unique filename with timestamp
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_{filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'parties', filename)
-            file.save(filepath)
-            flyer_path = f'uploads/parties/{filename}'
+    flyer_path = save_upload(request.files.get('flyer'))
     
     # Geocode location to get coordinates - S
     latitude, longitude = geocode_location(location)
-    
-    conn.execute(
-        """
-        INSERT INTO parties (user_id, host_name, party_name, location, latitude, longitude, date, time, description, flyer_path)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (user['id'], host_name, party_name, location, latitude, longitude, date, time, description, flyer_path),
-    )
-    conn.commit()
-    conn.close()  # Inserts new party into the parties database on wtm.db
+
+    def insert_party(conn):
+        conn.execute(
+            """
+            INSERT INTO parties (user_id, host_name, party_name, location, latitude, longitude, date, time, starts_at, description, flyer_path)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (user['id'], host_name, party_name, location, latitude, longitude, date, time, starts_at, description, flyer_path),
+        )
+        bump_data_version(conn, 'parties')
+
+    db_writer.run(insert_party)  # Inserts new party into the parties database on wtm.db
 
     return redirect(url_for('list_page'))
 
@@ -338,6 +2083,11 @@ def edit_party(party_id):
         date = request.form.get('date')
         time = request.form.get('time')
         description = request.form.get('description')
+
+        if not all([host_name, party_name, location, date, time]):
+            conn.close()
+            return render_template('edit_party.html', party=party, user=user,
+                                error="All fields except description are required.")
     
     # Security Feature so that the host name still matches - S
         user_data = conn.execute("SELECT display_name FROM users WHERE id = ?", (user['id'],)).fetchone()
@@ -346,18 +2096,15 @@ def edit_party(party_id):
             conn.close()
             return render_template('edit_party.html', party=party, user=user,
                                 error=f"Host name must match your username ({user_data['display_name']}).")
+
+        starts_at = make_starts_at(date, time)
+        if starts_at is None:
+            conn.close()
+            return render_template('edit_party.html', party=party, user=user,
+                                error="Date must be YYYY-MM-DD and time HH:MM.")
         
         # Handle flyer upload - S
-        flyer_path = party['flyer_path']
-        if 'flyer' in request.files:
-            file = request.files['flyer']
-            if file and file.filename != '' and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = f"{timestamp}_{filename}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'parties', filename)
-                file.save(filepath)
-                flyer_path = f'uploads/parties/{filename}'
+        flyer_path = save_upload(request.files.get('flyer')) or party['flyer_path']
         
         # Geocode location
         latitude, longitude = geocode_location(location)
@@ -366,12 +2113,16 @@ def edit_party(party_id):
             """
             UPDATE parties
             SET host_name = ?, party_name = ?, location = ?, latitude = ?, longitude = ?, 
-                date = ?, time = ?, description = ?, flyer_path = ?
+                date = ?, time = ?, starts_at = ?, description = ?, flyer_path = ?
             WHERE id = ?
             """,
-            (host_name, party_name, location, latitude, longitude, date, time, description, flyer_path, party_id)
+            (host_name, party_name, location, latitude, longitude, date, time, starts_at,
+             description, flyer_path, party_id)
         )
+        bump_data_version(conn, 'parties')
         conn.commit()
+        if flyer_path != party['flyer_path']:
+            discard_upload(conn, party['flyer_path'])  # The old flyer may not be used anywhere else now
         conn.close()
         return redirect(url_for('party_detail', party_id=party_id))  # Updates parties database with new party details
 
@@ -386,119 +2137,295 @@ def delete_party(party_id):
     if not user:
         return redirect(url_for('login_page'))
 
-    conn = get_db_connection()
-    party = conn.execute("SELECT * FROM parties WHERE id = ?", (party_id,)).fetchone()
-
-    # Permission check: ensure only user who created can delete
-    if party and party['user_id'] == user['id']:
-        conn.execute("DELETE FROM parties WHERE id = ?", (party_id,))  # Deletes party from the parties database
-        conn.commit()
-
-    conn.close()
-    return redirect(url_for('list_page'))
-
-
-# Creates a wishlist table in wt.db so users can save parties to their wishlist
-def init_wishlist_table():
-    conn = get_db_connection()
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS wishlist (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            party_id INTEGER NOT NULL,
-            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (party_id) REFERENCES parties(id) ON DELETE CASCADE,
-            UNIQUE(user_id, party_id)
-        );
-        """
-    )
-    conn.commit()
-    conn.close()
+    conn = get_db_connection()
+    party = conn.execute("SELECT * FROM parties WHERE id = ?", (party_id,)).fetchone()
+
+    # Permission check: ensure only user who created can delete
+    if party and party['user_id'] == user['id']:
+        conn.execute("DELETE FROM parties WHERE id = ?", (party_id,))  # Deletes party from the parties database
+        bump_data_version(conn, 'parties')
+        conn.commit()
+        discard_upload(conn, party['flyer_path'])
 
-init_wishlist_table()
+    conn.close()
+    return redirect(url_for('list_page'))
 
 
-# Creates the "posts" and "comments" tables for the live feed
-def init_feed_tables():
+# Command to fix comment counts by hand: flask --app app rebuild-comment-counts
+@app.cli.command('rebuild-comment-counts')
+def rebuild_comment_counts_command():
     conn = get_db_connection()
-    
-    # Creates posts table in wtm.db
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-        """
-    )
-    
-    # Creates comments table in wtm.db
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS comments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            post_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-        """
-    )
-    
+    rebuild_comment_counts(conn)
     conn.commit()
     conn.close()
+    print("Rebuilt comment counts for all posts")
 
-init_feed_tables()
 
+FEED_PAGE_SIZE = 20
 
-# Allows users table to be updated
-def update_users_table():
-    """Add display_name column to users table if it doesn't exist"""
-    conn = get_db_connection()
-    try:
-        # Try to add the column
-        conn.execute("ALTER TABLE users ADD COLUMN display_name TEXT")
-        conn.commit()
-        print("Added display_name column to users table")
-    except sqlite3.OperationalError:
-        # If column already exists
-        pass
-    conn.close()
 
-update_users_table()
+# Feed and comment cursors are an opaque "created_at|id" pair of the last row on a page
+def encode_cursor(row, column='created_at'):
+    raw = f"{row[column]}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
 
-# Creates a live feed where users can post and comment on the social scene
-@app.route('/feed')
-def feed():
-    user = current_user()
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeError):
+        return None
+
+
+# Gets one page of posts older than the cursor, newest first
+def get_feed_page(cursor=None, limit=FEED_PAGE_SIZE):
     conn = get_db_connection()
-    
-    # Get all posts with user info and comment count
-    posts = conn.execute(
-        """
+    query = """
         SELECT p.id,
+               p.user_id,
                p.content,
+               p.photo_path,
                p.created_at,
                u.display_name AS username,
-               COUNT(DISTINCT c.id) as comment_count
+               p.comment_count
         FROM posts p
         JOIN users u ON p.user_id = u.id
-        LEFT JOIN comments c ON p.id = c.post_id
-        GROUP BY p.id
-        ORDER BY p.created_at DESC
-        """
-    ).fetchall()
-    
+        {where}
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT ?
+    """
+    if cursor:
+        posts = conn.execute(
+            query.format(where="WHERE (p.created_at, p.id) < (?, ?)"),
+            (cursor[0], cursor[1], limit + 1),
+        ).fetchall()
+    else:
+        posts = conn.execute(query.format(where=""), (limit + 1,)).fetchall()
     conn.close()
-    return render_template('feed.html', posts=posts, user=user)
+
+    # We fetch one extra row just to know whether another page exists
+    next_cursor = encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+    return posts[:limit], next_cursor
+
+
+# Converts a post row into the JSON the "load more" script expects
+def post_to_dict(post):
+    return {
+        'id': post['id'],
+        'user_id': post['user_id'],
+        'username': post['username'],
+        'content': post['content'],
+        'photo_url': image_url(post['photo_path']) if post['photo_path'] else None,
+        'created_at': post['created_at'],
+        'comment_count': post['comment_count'],
+        'url': url_for('view_post', post_id=post['id']),
+    }
+
+
+# Live feed updates pushed to browsers with Server-Sent Events
+EVENT_HISTORY_SIZE = 500      # Recent events kept so reconnecting clients can catch up
+SUBSCRIBER_QUEUE_SIZE = 100   # Events a slow client may fall behind by before we drop it
+SSE_KEEPALIVE_SECONDS = 15
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = False
+
+
+class EventBroker:
+    """In-process publish/subscribe for feed events with a short replay history"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = collections.deque(maxlen=EVENT_HISTORY_SIZE)
+        self.last_event_id = 0
+
+    def dispatch(self, event_id, kind, data):
+        with self._lock:
+            self.last_event_id = max(self.last_event_id, event_id)
+            self._history.append((event_id, kind, data))
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait((event_id, kind, data))
+            except queue.Full:
+                # Too far behind: drop it rather than buffer forever. The browser reconnects
+                # with Last-Event-ID and catches up from the history.
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+    def subscribe(self, last_event_id=None, subscriber=None):
+        # Callers can pass their own subscriber, e.g. one feeding an asyncio stream (see asgi.py)
+        subscriber = subscriber or Subscriber()
+        with self._lock:
+            if last_event_id is not None:
+                for event in self._history:
+                    if event[0] > last_event_id and not subscriber.queue.full():
+                        subscriber.queue.put_nowait(event)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+class LocalEventAdapter:
+    """Single process: events go straight to the broker"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def publish(self, kind, data):
+        with self._lock:
+            event_id = next(self._ids)
+        self.broker.dispatch(event_id, kind, json.dumps(data, separators=(',', ':')))
+
+
+class SQLiteEventAdapter:
+    """Several worker processes: events are written to feed_events and every process polls for them.
+    Stands in for a real message bus (e.g. Redis pub/sub) with the same publish() interface."""
+
+    def __init__(self, broker, poll_interval=0.5, keep=EVENT_HISTORY_SIZE * 2, trim_every=100):
+        self.broker = broker
+        self.poll_interval = poll_interval
+        self.keep = keep
+        self.trim_every = trim_every
+        self._last_trimmed_id = 0
+        self._started = False
+        self._lock = threading.Lock()
+
+    def publish(self, kind, data):
+        conn = db_pool.acquire()
+        conn.execute(
+            "INSERT INTO feed_events (kind, data) VALUES (?, ?)", (kind, json.dumps(data, separators=(',', ':')))
+        )
+        conn.commit()
+        conn.close()
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        conn = db_pool.acquire()
+        self.broker.last_event_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM feed_events").fetchone()[0]
+        conn.close()
+        threading.Thread(target=self._poll, name='feed-events', daemon=True).start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.poll_once()
+
+    def poll_once(self):
+        conn = db_pool.acquire()
+        try:
+            rows = conn.execute(
+                "SELECT id, kind, data FROM feed_events WHERE id > ? ORDER BY id LIMIT 500",
+                (self.broker.last_event_id,),
+            ).fetchall()
+            for row in rows:
+                self.broker.dispatch(row['id'], row['kind'], row['data'])
+            # Trim the log every trim_every events so it doesn't grow forever (events arrive in
+            # batches, so the last id of a batch can skip right past any particular number)
+            if rows and rows[-1]['id'] - self._last_trimmed_id >= self.trim_every:
+                conn.execute("DELETE FROM feed_events WHERE id <= ?", (rows[-1]['id'] - self.keep,))
+                conn.commit()
+                self._last_trimmed_id = rows[-1]['id']
+        except sqlite3.Error as error:
+            app.logger.warning("Could not read feed events: %s", error)
+        finally:
+            conn.close()
+
+
+event_broker = EventBroker()
+if os.environ.get('FEED_EVENTS', 'local') == 'sqlite':
+    feed_events = SQLiteEventAdapter(event_broker)
+else:
+    feed_events = LocalEventAdapter(event_broker)
+
+
+# Lets pages tell the event stream where they left off so nothing published in between is missed
+@app.template_global()
+def latest_feed_event_id():
+    if isinstance(feed_events, SQLiteEventAdapter):
+        feed_events.start()
+    return event_broker.last_event_id
+
+
+# Server-Sent Events stream of new posts and comments
+@app.route('/feed/events')
+def feed_events_stream():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    if isinstance(feed_events, SQLiteEventAdapter):
+        feed_events.start()
+    subscriber = event_broker.subscribe(last_event_id)
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not subscriber.dropped:
+                try:
+                    event_id, kind, data = subscriber.queue.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"  # Stops proxies from closing an idle connection
+                    continue
+                yield f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+        finally:
+            event_broker.unsubscribe(subscriber)
+
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Tell nginx not to buffer the stream
+    return response
+
+
+# Creates a live feed where users can post and comment on the social scene
+@app.route('/feed')
+def feed():
+    user = current_user()
+
+    # Gets the newest page of posts (or the page after ?before=<cursor> without JavaScript)
+    cursor = None
+    if request.args.get('before'):
+        cursor = decode_cursor(request.args['before'])
+        if cursor is None:
+            return redirect(url_for('feed'))
+    posts, next_cursor = get_feed_page(cursor)
+
+    return render_template('feed.html', posts=posts, user=user, next_cursor=next_cursor)
+
+
+# API endpoint that returns the next page of posts for infinite scrolling
+@app.route('/api/feed')
+def feed_page_data():
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decode_cursor(request.args['cursor'])
+        if cursor is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+    posts, next_cursor = get_feed_page(cursor)
+    return streamed_json_response(stream_json(
+        map(post_to_dict, posts), key='posts', extra={'next_cursor': next_cursor}, compact=wants_compact_json()
+    ))
 
 
 # Allows user to create a post in the feed
@@ -513,24 +2440,32 @@ def create_post():
         return jsonify({'error': 'Post content cannot be empty'}), 400  # There must be content in the post
 
     # Handle photo upload for posts -S
-    photo_path = None
-    if 'photo' in request.files:
-        file = request.files['photo']
-        if file and file.filename != '' and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_{filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'posts', filename)
-            file.save(filepath)
-            photo_path = f'uploads/posts/{filename}'
+    photo_path = save_upload(request.files.get('photo'))
     
+    def insert_post(conn):
+        cursor = conn.execute(
+            "INSERT INTO posts (user_id, content, photo_path) VALUES (?, ?, ?)",
+            (user['id'], content, photo_path)
+        )
+        bump_data_version(conn, 'posts')
+        return cursor.lastrowid
+
+    post_id = db_writer.run(insert_post)  # Adds the post to the posts table
+
+    # Push the new post to everyone watching the feed
     conn = get_db_connection()
-    conn.execute(
-        "INSERT INTO posts (user_id, content, photo_path) VALUES (?, ?, ?)",
-        (user['id'], content, photo_path)
-    )
-    conn.commit()
-    conn.close()   # Adds the post to the posts table
+    post = conn.execute(
+        """
+        SELECT p.id, p.user_id, p.content, p.photo_path, p.created_at, p.comment_count,
+               u.display_name AS username
+        FROM posts p
+        JOIN users u ON p.user_id = u.id
+        WHERE p.id = ?
+        """,
+        (post_id,)
+    ).fetchone()
+    conn.close()
+    feed_events.publish('post', post_to_dict(post))
     
     return redirect(url_for('feed'))
 
@@ -549,6 +2484,7 @@ def view_post(post_id):
                p.content,
                p.photo_path,
                p.created_at,
+               p.comment_count,
                u.display_name AS username
         FROM posts p
         JOIN users u ON p.user_id = u.id
@@ -556,29 +2492,64 @@ def view_post(post_id):
         """,
         (post_id,)
     ).fetchone()
+    conn.close()
     
     if not post:
-        conn.close()
         return redirect(url_for('feed'))
     
-    # From comments, get all comments from this post
-    comments = conn.execute(
-        """
+    # The first page of comments (or the page after ?after=<cursor> without JavaScript)
+    cursor = decode_cursor(request.args['after']) if request.args.get('after') else None
+    comments, next_cursor = get_comments_page(post_id, cursor)
+    
+    return render_template('post_detail.html', post=post, comments=comments, user=user, next_cursor=next_cursor)
+
+
+COMMENTS_PAGE_SIZE = 50
+
+
+# Gets one page of a post's comments after the cursor, oldest first
+def get_comments_page(post_id, cursor=None, limit=COMMENTS_PAGE_SIZE):
+    query = """
         SELECT c.id,
+               c.post_id,
                c.content,
                c.created_at,
                c.user_id,
                u.display_name AS username
         FROM comments c
         JOIN users u ON c.user_id = u.id
-        WHERE c.post_id = ?
-        ORDER BY c.created_at ASC
-        """,
-        (post_id,)
-    ).fetchall()
-    
+        WHERE c.post_id = ? {where}
+        ORDER BY c.created_at, c.id
+        LIMIT ?
+    """
+    conn = get_db_connection()
+    if cursor:
+        comments = conn.execute(
+            query.format(where="AND (c.created_at, c.id) > (?, ?)"),
+            (post_id, cursor[0], cursor[1], limit + 1),
+        ).fetchall()
+    else:
+        comments = conn.execute(query.format(where=""), (post_id, limit + 1)).fetchall()
     conn.close()
-    return render_template('post_detail.html', post=post, comments=comments, user=user)
+
+    # One extra row tells us whether there is another page
+    next_cursor = encode_cursor(comments[limit - 1]) if len(comments) > limit else None
+    return comments[:limit], next_cursor
+
+
+# API endpoint that returns the next page of a post's comments
+@app.route('/api/feed/post/<int:post_id>/comments')
+def comments_page_data(post_id):
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decode_cursor(request.args['cursor'])
+        if cursor is None:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+    comments, next_cursor = get_comments_page(post_id, cursor)
+    return streamed_json_response(stream_json(
+        map(dict, comments), key='comments', extra={'next_cursor': next_cursor}, compact=wants_compact_json()
+    ))
 
 
 # Allows user to create a comment on a post
@@ -592,20 +2563,35 @@ def create_comment(post_id):
     if not content:
         return jsonify({'error': 'Comment content cannot be empty'}), 400  # Comment must have content
     
-    conn = get_db_connection()
-    
-    # Ensure that the post being commented on exists
-    post = conn.execute("SELECT id FROM posts WHERE id = ?", (post_id,)).fetchone()
-    if not post:
-        conn.close()
+    def insert_comment(conn):
+        # Ensure that the post being commented on exists
+        post = conn.execute("SELECT id FROM posts WHERE id = ?", (post_id,)).fetchone()
+        if not post:
+            return None
+        cursor = conn.execute(
+            "INSERT INTO comments (post_id, user_id, content) VALUES (?, ?, ?)",
+            (post_id, user['id'], content)
+        )
+        bump_data_version(conn, 'comments')
+        return cursor.lastrowid
+
+    comment_id = db_writer.run(insert_comment)  # Adds comment to the comments table
+    if comment_id is None:
         return jsonify({'error': 'Post not found'}), 404  # If the post does not exist
-    
-    conn.execute(
-        "INSERT INTO comments (post_id, user_id, content) VALUES (?, ?, ?)",
-        (post_id, user['id'], content)
-    )
-    conn.commit()
-    conn.close()  # Adds comment to the comments table
+
+    # Push the new comment to anyone viewing the post or the feed
+    conn = get_db_connection()
+    comment = conn.execute(
+        """
+        SELECT c.id, c.post_id, c.user_id, c.content, c.created_at, u.display_name AS username
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.id = ?
+        """,
+        (comment_id,)
+    ).fetchone()
+    conn.close()
+    feed_events.publish('comment', dict(comment))
     
     return redirect(url_for('view_post', post_id=post_id))
 
@@ -623,7 +2609,12 @@ def delete_post(post_id):
     # Ensure only the creator can delete the post
     if post and post['user_id'] == user['id']:
         conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+        # Foreign keys aren't enforced on these connections, so the cascade has to be done here
+        # (the triggers take the comments out of the search index too)
+        conn.execute("DELETE FROM comments WHERE post_id = ?", (post_id,))
+        bump_data_version(conn, 'posts')
         conn.commit()
+        discard_upload(conn, post['photo_path'])
     
     conn.close()
     return redirect(url_for('feed'))
@@ -643,6 +2634,7 @@ def delete_comment(comment_id):
     if comment and comment['user_id'] == user['id']:
         post_id = comment['post_id']
         conn.execute("DELETE FROM comments WHERE id = ?", (comment_id,))
+        bump_data_version(conn, 'comments')
         conn.commit()
         conn.close()
         return redirect(url_for('view_post', post_id=post_id))
@@ -659,7 +2651,7 @@ def settings():
         return redirect(url_for('login_page'))
     
     conn = get_db_connection()
-    user_data = conn.execute("SELECT display_name FROM users WHERE id = ?", (user['id'],)).fetchone()
+    user_data = profile_cache.get(user['id'])
     
     if request.method == 'POST':
         new_username = request.form.get('username', '').strip()
@@ -692,7 +2684,11 @@ def settings():
         
         # Allow user to udpate their username and in wtm.db
         conn.execute("UPDATE users SET display_name = ? WHERE id = ?", (new_username, user['id']))
+        # Party cards and posts show the display name, so cached copies need re-rendering
+        bump_data_version(conn, 'parties')
+        bump_data_version(conn, 'posts')
         conn.commit()
+        profile_cache.invalidate(user['id'])
         session['username'] = new_username
         conn.close()
         
@@ -703,22 +2699,95 @@ def settings():
     return render_template('settings.html', user=user, current_username=user_data['display_name'])
 
 
-# This gets user's wishlist party IDs
-def get_user_wishlist_ids(user_id):
-    """Returns a set of party IDs that are in the user's wishlist"""
-    if not user_id:
-        return set()
-    
+# Per-user wishlist sets kept in memory so the party list doesn't re-read them on every view
+WISHLIST_CACHE_USERS = int(os.environ.get('WISHLIST_CACHE_USERS', 1000))
+WISHLIST_CACHE_TTL = 60  # Seconds; bounds staleness when other worker processes change a wishlist
+WISHLIST_BATCH_LIMIT = 500
+
+
+class WishlistCache:
+    """LRU of user_id -> set of saved party ids, kept current by this process's toggles"""
+
+    def __init__(self, max_users, ttl):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, load):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return set(entry[1])
+            self.misses += 1
+        party_ids = load(user_id)
+        with self._lock:
+            self._entries[user_id] = (now, party_ids)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return set(party_ids)
+
+    def update(self, user_id, added=(), removed=()):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry:
+                entry[1].update(added)
+                entry[1].difference_update(removed)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'users': len(self._entries)}
+
+
+wishlist_cache = WishlistCache(WISHLIST_CACHE_USERS, WISHLIST_CACHE_TTL)
+
+
+def load_wishlist_ids(user_id):
     conn = get_db_connection()
     wishlist_items = conn.execute(
         "SELECT party_id FROM wishlist WHERE user_id = ?",
         (user_id,)
     ).fetchall()
     conn.close()
-    
     return {item['party_id'] for item in wishlist_items}
 
 
+# This gets user's wishlist party IDs
+def get_user_wishlist_ids(user_id):
+    """Returns a set of party IDs that are in the user's wishlist"""
+    if not user_id:
+        return set()
+    return wishlist_cache.get(user_id, load_wishlist_ids)
+
+
+# Each of these is a single statement; they return True if the wishlist changed
+def add_to_wishlist(conn, user_id, party_id):
+    # Only inserts if the party exists and isn't already saved
+    cursor = conn.execute(
+        """
+        INSERT INTO wishlist (user_id, party_id)
+        SELECT ?, id FROM parties WHERE id = ?
+        ON CONFLICT(user_id, party_id) DO NOTHING
+        """,
+        (user_id, party_id)
+    )
+    return cursor.rowcount > 0
+
+
+def remove_from_wishlist(conn, user_id, party_id):
+    cursor = conn.execute(
+        "DELETE FROM wishlist WHERE user_id = ? AND party_id = ?",
+        (user_id, party_id)
+    )
+    return cursor.rowcount > 0
+
+
 # This allows wishlist data to appear in the list route as well
 @app.route('/list')
 def list_page():
@@ -741,7 +2810,8 @@ def list_page():
                u.display_name AS verified_host
         FROM parties p
         JOIN users u ON p.user_id = u.id
-        ORDER BY p.date, p.time
+        WHERE p.starts_at >= datetime('now', 'localtime')
+        ORDER BY p.starts_at
         """
     ).fetchall()
     conn.close()
@@ -751,12 +2821,127 @@ def list_page():
     
     return render_template('list.html', parties=parties, user=user, user_wishlist=user_wishlist)
 
-# API endpoint to get party locations for map - S
-@app.route('/api/parties/map')
-def parties_map_data():
-    conn = get_db_connection()
-    parties = conn.execute(
+# Parties that ended more than PARTY_RETENTION_DAYS ago move to parties_archive (and their
+# wishlist rows to wishlist_archive) so the live tables only hold what people still browse
+PARTY_RETENTION_DAYS = int(os.environ.get('PARTY_RETENTION_DAYS', 30))
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_INTERVAL_MINUTES = int(os.environ.get('ARCHIVE_INTERVAL_MINUTES', 0))  # 0 = only via the CLI
+ARCHIVED_PARTY_COLUMNS = (
+    "id, user_id, host_name, party_name, location, latitude, longitude, "
+    "date, time, starts_at, description, flyer_path, created_at"
+)
+HISTORY_PAGE_SIZE = 20
+
+
+def archive_party_batch(conn, retention_days=PARTY_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Moves up to batch_size old parties into the archive; returns how many moved"""
+    party_ids = [row['id'] for row in conn.execute(
         """
+        SELECT id FROM parties
+        WHERE starts_at < datetime('now', 'localtime', ?)
+        ORDER BY starts_at
+        LIMIT ?
+        """,
+        (f'-{retention_days} days', batch_size),
+    )]
+    if not party_ids:
+        return 0
+
+    placeholders = ', '.join('?' * len(party_ids))
+    conn.execute(
+        f"INSERT OR REPLACE INTO parties_archive ({ARCHIVED_PARTY_COLUMNS}) "
+        f"SELECT {ARCHIVED_PARTY_COLUMNS} FROM parties WHERE id IN ({placeholders})",
+        party_ids,
+    )
+    conn.execute(
+        f"INSERT OR REPLACE INTO wishlist_archive (user_id, party_id, added_at) "
+        f"SELECT user_id, party_id, added_at FROM wishlist WHERE party_id IN ({placeholders})",
+        party_ids,
+    )
+    conn.execute(f"DELETE FROM wishlist WHERE party_id IN ({placeholders})", party_ids)
+    conn.execute(f"DELETE FROM parties WHERE id IN ({placeholders})", party_ids)
+    bump_data_version(conn, 'parties')
+    return len(party_ids)
+
+
+def archive_old_parties(retention_days=PARTY_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    # Each batch is its own short transaction on the writer queue, so regular writes
+    # get their turn between batches instead of waiting for the whole job
+    total = 0
+    while True:
+        moved = db_writer.run(lambda conn: archive_party_batch(conn, retention_days, batch_size))
+        total += moved
+        if moved < batch_size:
+            return total
+
+
+# Archive old parties: flask --app app archive-parties (e.g. nightly from cron)
+@app.cli.command('archive-parties')
+def archive_parties_command():
+    moved = archive_old_parties()
+    print(f"Archived {moved} parties that ended more than {PARTY_RETENTION_DAYS} days ago")
+
+
+archive_scheduler_lock = threading.Lock()
+archive_scheduler_started = False
+
+
+def run_archive_schedule():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_MINUTES * 60)
+        try:
+            moved = archive_old_parties()
+            if moved:
+                app.logger.info("Archived %d old parties", moved)
+        except Exception:
+            # Whatever went wrong, the next run might work, so keep the thread alive
+            app.logger.exception("Could not archive old parties")
+
+
+# With ARCHIVE_INTERVAL_MINUTES set, each worker also archives on a timer (it's idempotent)
+@app.before_request
+def start_archive_scheduler():
+    global archive_scheduler_started
+    if not ARCHIVE_INTERVAL_MINUTES or archive_scheduler_started:
+        return
+    with archive_scheduler_lock:
+        if not archive_scheduler_started:
+            archive_scheduler_started = True
+            threading.Thread(target=run_archive_schedule, name='party-archive', daemon=True).start()
+
+
+# Past parties, newest first - both ones that just ended and ones already archived
+@app.route('/list/history')
+def party_history():
+    cursor = decode_cursor(request.args['before']) if request.args.get('before') else None
+    # Each table is read in index order and cut to one page before the two are merged
+    columns = "id, party_name, location, date, time, description, host_name, flyer_path, starts_at"
+    branch = """
+        SELECT * FROM (
+            SELECT {columns} FROM {table}
+            WHERE starts_at < datetime('now', 'localtime') {where}
+            ORDER BY starts_at DESC, id DESC
+            LIMIT ?
+        )
+    """
+    where = "AND (starts_at, id) < (?, ?)" if cursor else ""
+    query = (
+        branch.format(columns=columns, table='parties', where=where)
+        + " UNION ALL "
+        + branch.format(columns=columns, table='parties_archive', where=where)
+        + " ORDER BY starts_at DESC, id DESC LIMIT ?"
+    )
+    branch_args = (*cursor, HISTORY_PAGE_SIZE + 1) if cursor else (HISTORY_PAGE_SIZE + 1,)
+
+    conn = get_db_connection()
+    parties = conn.execute(query, branch_args + branch_args + (HISTORY_PAGE_SIZE + 1,)).fetchall()
+    conn.close()
+
+    next_cursor = encode_cursor(parties[HISTORY_PAGE_SIZE - 1], 'starts_at') if len(parties) > HISTORY_PAGE_SIZE else None
+    return render_template('history.html', parties=parties[:HISTORY_PAGE_SIZE], next_cursor=next_cursor)
+
+
+MAP_PARTY_COLUMNS = """
         SELECT p.id,
                p.party_name,
                p.location,
@@ -764,32 +2949,358 @@ def parties_map_data():
                p.longitude,
                p.date,
                p.time,
+               p.starts_at,
                u.display_name AS verified_host
-        FROM parties p
+"""
+
+
+# Convert to JSON format - S
+def map_party_to_dict(party):
+    return {
+        'id': party['id'],
+        'name': party['party_name'],
+        'location': party['location'],
+        'latitude': party['latitude'],
+        'longitude': party['longitude'],
+        'date': party['date'],
+        'time': party['time'],
+        'host': party['verified_host']
+    }
+
+
+# Cached JSON for the map, rebuilt only when parties change or the soonest party starts
+map_cache = {}
+
+
+def build_map_cache(conn, version):
+    def upcoming_parties():
+        return conn.execute(
+            MAP_PARTY_COLUMNS + """
+            FROM parties p
+            JOIN users u ON p.user_id = u.id
+            WHERE p.starts_at >= datetime('now', 'localtime')
+            AND p.latitude IS NOT NULL
+            AND p.longitude IS NOT NULL
+            ORDER BY p.starts_at
+            """
+        )
+
+    # Built straight from the cursor, once per format, so the rows are never all in memory
+    bodies = {}
+    for compact in (False, True):
+        chunks = stream_json(map(map_party_to_dict, upcoming_parties()), compact=compact)
+        bodies[compact] = ''.join(chunks).encode()
+    soonest = upcoming_parties().fetchone()
+    return {
+        'version': version,
+        # The list changes once the soonest party has started, even if nobody edits anything
+        'expires_at': soonest['starts_at'] if soonest else None,
+        'bodies': bodies,
+        'gzipped': {},  # Filled in the first time a client asks for gzip
+        'etag': hashlib.sha256(bodies[False]).hexdigest(),
+        'last_modified': datetime.now(timezone.utc).replace(microsecond=0),
+    }
+
+
+# Distance in meters between two points on the map
+def distance_meters(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+# Reads ?bbox=west,south,east,north or ?lat=&lng=&radius= (meters) from the request
+def parse_map_viewport(args):
+    """Returns (bounding box, circle) where either may be None; raises ValueError on bad input"""
+    if 'bbox' in args:
+        west, south, east, north = (float(value) for value in args['bbox'].split(','))
+        if south > north or west > east:
+            raise ValueError("bbox must be west,south,east,north")
+        return (south, north, west, east), None
+
+    if 'lat' in args or 'lng' in args or 'radius' in args:
+        lat, lng, radius = float(args['lat']), float(args['lng']), float(args['radius'])
+        if radius <= 0 or not -90 <= lat <= 90:
+            raise ValueError("radius must be positive and lat between -90 and 90")
+        # Search the square around the circle, then trim the corners
+        lat_delta = radius / 111320
+        lng_delta = radius / (111320 * max(math.cos(math.radians(lat)), 1e-6))
+        return (lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta), (lat, lng, radius)
+
+    return None, None
+
+
+def get_parties_in_view(conn, box, circle):
+    south, north, west, east = box
+    parties = conn.execute(
+        MAP_PARTY_COLUMNS + """
+        FROM party_locations r
+        JOIN parties p ON p.id = r.id
         JOIN users u ON p.user_id = u.id
-        WHERE datetime(p.date || ' ' || p.time) >= datetime('now', 'localtime')
-        AND p.latitude IS NOT NULL
-        AND p.longitude IS NOT NULL
-        ORDER BY datetime(p.date || ' ' || p.time)
-        """
+        WHERE r.min_lat <= ? AND r.max_lat >= ?
+        AND r.min_lng <= ? AND r.max_lng >= ?
+        AND p.starts_at >= datetime('now', 'localtime')
+        ORDER BY p.starts_at
+        """,
+        (north, south, east, west),
+    )
+
+    # Rows come off the cursor one at a time as the response streams
+    if circle:
+        lat, lng, radius = circle
+        parties = (
+            party for party in parties
+            if distance_meters(lat, lng, party['latitude'], party['longitude']) <= radius
+        )
+    return parties
+
+
+# A part of the map only changes when a party does or the soonest party starts, so that plus
+# the area asked for is enough to name the response (read before the rows, so it's never newer)
+def map_viewport_etag(conn, box, circle, compact):
+    soonest = conn.execute(
+        "SELECT MIN(starts_at) FROM parties WHERE starts_at >= datetime('now', 'localtime')"
+    ).fetchone()[0]
+    key = [get_data_version(conn, 'parties'), soonest, [round(value, 6) for value in box], circle, compact]
+    return hashlib.sha256(encode_json(key).encode()).hexdigest()
+
+
+# JSON APIs stream their results instead of building the whole list and jsonify-ing it.
+# ?format=columns sends the field names once and each item as an array of values
+JSON_CHUNK_ITEMS = 200   # Items encoded per chunk written to the client
+JSON_GZIP_LEVEL = 6
+encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def stream_json(items, key=None, extra=None, compact=False):
+    """Yields JSON text for an iterable of dicts, a chunk at a time.
+    Without a key the items are a bare array; with one they go in {key: [...], **extra}"""
+    items = iter(items)
+    first = next(items, None)
+    fields = list(first) if first is not None else []
+    list_key = key or ('rows' if compact else None)
+
+    head = '{"fields":' + encode_json(fields) + ',' if compact else '{' if key else ''
+    chunk = [head + (encode_json(list_key) + ':' if list_key else '') + '[']
+    if first is not None:
+        for index, item in enumerate(itertools.chain([first], items)):
+            value = [item[field] for field in fields] if compact else item
+            chunk.append((',' if index else '') + encode_json(value))
+            if len(chunk) >= JSON_CHUNK_ITEMS:
+                yield ''.join(chunk)
+                chunk = []
+    chunk.append(']')
+    if list_key:
+        for name, value in (extra or {}).items():
+            chunk.append(',' + encode_json(name) + ':' + encode_json(value))
+        chunk.append('}')
+    yield ''.join(chunk)
+
+
+def wants_compact_json():
+    return request.args.get('format') == 'columns'
+
+
+def wants_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(JSON_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def streamed_json_response(chunks):
+    """Streams stream_json() output, gzipped if the client accepts it"""
+    body = (chunk.encode() for chunk in chunks)
+    gzipped = wants_gzip()
+    if gzipped:
+        body = gzip_chunks(body)
+    # stream_with_context keeps the request's pooled connection open until the last row
+    response = app.response_class(stream_with_context(body), mimetype='application/json')
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# Browsers revalidate every time but get a bodyless 304 when nothing changed
+def conditional_json_response(body, etag, last_modified=None, gzipped=False):
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# API endpoint to get party locations for map - S
+@app.route('/api/parties/map')
+def parties_map_data():
+    global map_cache
+    try:
+        box, circle = parse_map_viewport(request.args)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Use bbox=west,south,east,north or lat, lng and radius (meters)'}), 400
+
+    conn = get_db_connection()
+    compact = wants_compact_json()
+
+    # Only the parties inside the requested part of the map
+    if box:
+        etag = map_viewport_etag(conn, box, circle, compact) + ('-gzip' if wants_gzip() else '')
+        if request.if_none_match.contains(etag):
+            conn.close()
+            return conditional_json_response(b'', etag)  # Answered before running the R*Tree query
+        parties = get_parties_in_view(conn, box, circle)
+        conn.close()
+        response = streamed_json_response(stream_json(map(map_party_to_dict, parties), compact=compact))
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+
+    version = get_data_version(conn, 'parties')
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    cache = map_cache
+    if not cache or cache['version'] != version or (cache['expires_at'] and cache['expires_at'] < now):
+        cache = build_map_cache(conn, version)
+        map_cache = cache
+    conn.close()
+
+    body, etag = cache['bodies'][compact], cache['etag'] + ('-columns' if compact else '')
+    gzipped = wants_gzip()
+    if gzipped:
+        if compact not in cache['gzipped']:
+            cache['gzipped'][compact] = gzip.compress(body, JSON_GZIP_LEVEL, mtime=0)
+        body, etag = cache['gzipped'][compact], etag + '-gzip'
+    return conditional_json_response(body, etag, cache['last_modified'], gzipped)
+
+
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_PAGE = 50  # Deep pages of ranked results get slow and nobody reads them
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'  # Swapped for <mark> after escaping
+
+SEARCH_QUERIES = {
+    'parties': """
+        SELECT p.id,
+               p.party_name AS title,
+               p.date || ' @ ' || p.time AS subtitle,
+               snippet(parties_fts, -1, ?, ?, '…', 16) AS snippet
+        FROM parties_fts
+        JOIN parties p ON p.id = parties_fts.rowid
+        WHERE parties_fts MATCH ?
+        ORDER BY bm25(parties_fts, 10.0, 4.0, 1.0, 4.0)
+        LIMIT ? OFFSET ?
+    """,
+    'posts': """
+        SELECT p.id,
+               u.display_name AS title,
+               p.created_at AS subtitle,
+               snippet(posts_fts, 0, ?, ?, '…', 16) AS snippet
+        FROM posts_fts
+        JOIN posts p ON p.id = posts_fts.rowid
+        JOIN users u ON p.user_id = u.id
+        WHERE posts_fts MATCH ?
+        ORDER BY bm25(posts_fts)
+        LIMIT ? OFFSET ?
+    """,
+    'comments': """
+        SELECT c.post_id AS id,
+               u.display_name AS title,
+               c.created_at AS subtitle,
+               snippet(comments_fts, 0, ?, ?, '…', 16) AS snippet
+        FROM comments_fts
+        JOIN comments c ON c.id = comments_fts.rowid
+        JOIN posts p ON p.id = c.post_id
+        JOIN users u ON c.user_id = u.id
+        WHERE comments_fts MATCH ?
+        ORDER BY bm25(comments_fts)
+        LIMIT ? OFFSET ?
+    """,
+}
+
+
+# Turns what the user typed into an FTS5 query where every word is a prefix match
+def build_search_query(text):
+    words = re.findall(r"\w+", text.lower())
+    return ' '.join(f'"{word}"*' for word in words[:10])
+
+
+def highlight_snippet(snippet):
+    return str(escape(snippet)).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+def search(kind, text, page=1):
+    """Returns (results, has_more) for one page of ranked matches"""
+    match = build_search_query(text)
+    if not match:
+        return [], False
+
+    conn = get_db_connection()
+    rows = conn.execute(
+        SEARCH_QUERIES[kind],
+        (SNIPPET_START, SNIPPET_END, match, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE),
     ).fetchall()
     conn.close()
-    
-    # Convert to JSON format - S
-    parties_data = []
-    for party in parties:
-        parties_data.append({
-            'id': party['id'],
-            'name': party['party_name'],
-            'location': party['location'],
-            'latitude': party['latitude'],
-            'longitude': party['longitude'],
-            'date': party['date'],
-            'time': party['time'],
-            'host': party['verified_host']
-        })
-    
-    return jsonify(parties_data)
+
+    endpoint, arg = ('party_detail', 'party_id') if kind == 'parties' else ('view_post', 'post_id')
+    results = [
+        {
+            'id': row['id'],
+            'title': row['title'],
+            'subtitle': row['subtitle'],
+            'snippet': highlight_snippet(row['snippet'] or ''),
+            'url': url_for(endpoint, **{arg: row['id']}),
+        }
+        for row in rows[:SEARCH_PAGE_SIZE]
+    ]
+    return results, len(rows) > SEARCH_PAGE_SIZE
+
+
+def read_search_args():
+    text = request.args.get('q', '').strip()[:200]
+    kind = request.args.get('type', 'all')
+    page = min(max(request.args.get('page', 1, type=int), 1), SEARCH_MAX_PAGE)
+    return text, kind, page
+
+
+# Search page for parties, posts and comments
+@app.route('/search')
+def search_page():
+    text, kind, page = read_search_args()
+    kinds = [kind] if kind in SEARCH_QUERIES else list(SEARCH_QUERIES)
+
+    sections = {}
+    if text:
+        for name in kinds:
+            results, has_more = search(name, text, page if len(kinds) == 1 else 1)
+            sections[name] = {'results': results, 'has_more': has_more}
+
+    return render_template('search.html', query=text, kind=kind if len(kinds) == 1 else 'all',
+                           page=page, sections=sections)
+
+
+# API endpoint for search results, one type per request
+@app.route('/api/search')
+def search_data():
+    text, kind, page = read_search_args()
+    if kind not in SEARCH_QUERIES:
+        return jsonify({'error': 'type must be parties, posts or comments'}), 400
+
+    results, has_more = search(kind, text, page)
+    return streamed_json_response(stream_json(
+        results, key='results', extra={'next_page': page + 1 if has_more and page < SEARCH_MAX_PAGE else None},
+        compact=wants_compact_json(),
+    ))
+
 
 # This creates a wishlist page on the website
 @app.route('/wishlist')
@@ -835,40 +3346,122 @@ def toggle_wishlist(party_id):
     user = current_user()
     if not user:
         return jsonify({'error': 'Not authenticated'}), 401
-    
-    conn = get_db_connection()
-    
-    # Ensure that their party exists
-    party = conn.execute("SELECT id FROM parties WHERE id = ?", (party_id,)).fetchone()
-    if not party:
-        conn.close()
+
+    # The cached set says which way to toggle, so normally this is one statement
+    in_wishlist = party_id in get_user_wishlist_ids(user['id'])
+
+    def toggle(conn):
+        if in_wishlist and remove_from_wishlist(conn, user['id'], party_id):
+            return 'removed'
+        if add_to_wishlist(conn, user['id'], party_id):
+            return 'added'
+        if remove_from_wishlist(conn, user['id'], party_id):
+            return 'removed'  # The cache was out of date and the party was already saved
+        return None
+
+    action = db_writer.run(toggle)
+    if action is None:
         return jsonify({'error': 'Party not found'}), 404
-    
-    # Checks if the party is already in the wishlist
-    existing = conn.execute(
-        "SELECT id FROM wishlist WHERE user_id = ? AND party_id = ?",
-        (user['id'], party_id)
-    ).fetchone()
-    
-    if existing:
-        # If the user would like to remove party from their wishlist
-        conn.execute(
-            "DELETE FROM wishlist WHERE user_id = ? AND party_id = ?",
-            (user['id'], party_id)
-        )
-        conn.commit()
-        conn.close()
-        return jsonify({'action': 'removed', 'party_id': party_id})
+
+    if action == 'added':
+        wishlist_cache.update(user['id'], added=[party_id])
     else:
-        # If the user would like to add a party to their wishlist
-        conn.execute(
-            "INSERT INTO wishlist (user_id, party_id) VALUES (?, ?)",
-            (user['id'], party_id)
-        )
-        conn.commit()
-        conn.close()
-        return jsonify({'action': 'added', 'party_id': party_id})
-    
+        wishlist_cache.update(user['id'], removed=[party_id])
+    return jsonify({'action': action, 'party_id': party_id})
+
+
+# Applies many wishlist adds/removes in one transaction (e.g. changes a phone made offline)
+@app.route('/api/wishlist/batch', methods=['POST'])
+def wishlist_batch():
+    user = current_user()
+    if not user:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or len(operations) > WISHLIST_BATCH_LIMIT:
+        return jsonify({'error': f'operations must be a list of at most {WISHLIST_BATCH_LIMIT} items'}), 400
+
+    # Only the last operation for each party matters
+    final_actions = {}
+    for operation in operations:
+        if not isinstance(operation, dict):
+            return jsonify({'error': 'Each operation needs a party_id and an action'}), 400
+        party_id, action = operation.get('party_id'), operation.get('action')
+        if not isinstance(party_id, int) or action not in ('add', 'remove'):
+            return jsonify({'error': 'Each operation needs an integer party_id and action "add" or "remove"'}), 400
+        final_actions.pop(party_id, None)
+        final_actions[party_id] = action
+
+    results = []
+    added, removed = [], []
+
+    def apply_operations(conn):
+        for party_id, action in final_actions.items():
+            if action == 'add':
+                if add_to_wishlist(conn, user['id'], party_id):
+                    result = 'added'
+                    added.append(party_id)
+                elif conn.execute("SELECT 1 FROM parties WHERE id = ?", (party_id,)).fetchone():
+                    result = 'unchanged'
+                else:
+                    result = 'not_found'
+            else:
+                if remove_from_wishlist(conn, user['id'], party_id):
+                    result = 'removed'
+                    removed.append(party_id)
+                else:
+                    result = 'unchanged'
+            results.append({'party_id': party_id, 'result': result})
+
+    # The writer rolls back the whole set of operations if any of them fails
+    try:
+        db_writer.run(apply_operations)
+    except sqlite3.Error:
+        return jsonify({'error': 'Could not update wishlist, nothing was changed'}), 500
+
+    wishlist_cache.update(user['id'], added=added, removed=removed)
+    return jsonify({'results': results})
+
+
+# Prometheus text format; scrape it with a job pointed at /metrics
+@app.route('/metrics')
+def metrics():
+    lines = []
+    for histogram in (request_seconds, request_db_seconds, request_template_seconds, request_queries,
+                      db_writer.batch_sizes, db_writer.wait_seconds):
+        lines.extend(histogram.render())
+
+    lines += ["# HELP wtm_db_statement_calls_total Times each normalized statement ran during requests",
+              "# TYPE wtm_db_statement_calls_total counter"]
+    seconds = ["# HELP wtm_db_statement_seconds_total Time spent in each normalized statement",
+               "# TYPE wtm_db_statement_seconds_total counter"]
+    with statement_totals_lock:
+        for sql, (calls, total) in sorted(statement_totals.items()):
+            lines.append(f'wtm_db_statement_calls_total{{sql="{metric_label(sql)}"}} {calls}')
+            seconds.append(f'wtm_db_statement_seconds_total{{sql="{metric_label(sql)}"}} {total}')
+    lines += seconds
+
+    # The caches and pools already keep their own counters
+    gauges = {
+        'wtm_db_pool': db_pool.stats(),
+        'wtm_db_writer': db_writer.stats(),
+        'wtm_password_hasher': password_hasher.stats(),
+        'wtm_wishlist_cache': wishlist_cache.stats(),
+        'wtm_profile_cache': profile_cache.stats(),
+        'wtm_fragment_cache': {key: value for key, value in fragment_cache.stats().items() if key != 'fragments'},
+        'wtm_feed_events': {'subscribers': event_broker.subscriber_count()},
+    }
+    for prefix, stats in gauges.items():
+        for key, value in stats.items():
+            lines += [f"# TYPE {prefix}_{key} gauge", f"{prefix}_{key} {value}"]
+    for counter in ('hits', 'misses'):
+        lines.append(f"# TYPE wtm_fragment_cache_{counter}_total counter")
+        for name, counts in sorted(fragment_cache.stats()['fragments'].items()):
+            lines.append(f'wtm_fragment_cache_{counter}_total{{fragment="{metric_label(name)}"}} {counts[counter]}')
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""ASGI entry point for WTM Harvard: uvicorn asgi:application
+
+The event loop receives each request body and spools it to a temp file before any
+thread is involved, so a slow 16MB upload costs a socket and a file, not a worker.
+The Flask app (and every database call it makes) then runs on a bounded thread pool,
+and /feed/events is served straight from the event loop so idle SSE connections
+don't hold threads at all.
+"""
+import asyncio
+import collections
+import os
+import queue
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# uvicorn usually runs several worker processes, and only the SQLite event log reaches
+# SSE clients connected to the other workers (FEED_EVENTS=local still works with one worker)
+os.environ.setdefault('FEED_EVENTS', 'sqlite')
+
+from app import (app, db_pool, event_broker, feed_events, password_hasher, SQLiteEventAdapter,
+                 SSE_KEEPALIVE_SECONDS, SUBSCRIBER_QUEUE_SIZE)
+
+# One thread per pooled connection by default, so threads never wait on the pool
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', db_pool.max_size))
+UPLOAD_SPOOL_BYTES = 256 * 1024  # Bodies bigger than this go to disk while they arrive
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='flask')
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] != 'http':
+        return  # No websockets
+    elif scope['path'] == '/feed/events' and scope['method'] == 'GET':
+        await feed_events_stream(scope, receive, send)
+    else:
+        await call_flask(scope, receive, send)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            # Stop the hashing processes here; left for interpreter exit, a uvicorn worker hangs
+            password_hasher.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def send_simple_response(send, status, text):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': text.encode()})
+
+
+async def call_flask(scope, receive, send):
+    max_length = app.config['MAX_CONTENT_LENGTH']
+    headers = dict(scope['headers'])
+    if max_length and int(headers.get(b'content-length', 0)) > max_length:
+        await send_simple_response(send, 413, "Upload is too large")
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES) as body:
+        received = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return  # The client gave up mid-upload
+            chunk = message.get('body', b'')
+            received += len(chunk)
+            if max_length and received > max_length:
+                await send_simple_response(send, 413, "Upload is too large")
+                return
+            body.write(chunk)
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, body)
+        # The whole body is here now, so chunked uploads get a real length too
+        environ['CONTENT_LENGTH'] = str(received)
+        await loop.run_in_executor(executor, run_flask, environ, loop, send)
+
+
+def build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.input_terminated': True,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def run_flask(environ, loop, send):
+    """Runs on the thread pool; hands each chunk of the response back to the event loop"""
+    started = {}
+
+    def send_from_thread(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+    def send_start():
+        send_from_thread({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+
+    response = app(environ, start_response)
+    try:
+        headers_sent = False
+        for chunk in response:
+            if not chunk:
+                continue
+            if not headers_sent:
+                send_start()
+                headers_sent = True
+            send_from_thread({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not headers_sent:
+            send_start()
+        send_from_thread({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+
+
+class LoopQueue:
+    """The bits of queue.Queue the event broker uses, feeding a coroutine on the event loop"""
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.ready = asyncio.Event()
+        self.lock = threading.Lock()
+
+    def full(self):
+        return len(self.items) >= self.maxsize
+
+    def put_nowait(self, item):
+        # Called from whichever thread published the event
+        with self.lock:
+            if self.full():
+                raise queue.Full
+            self.items.append(item)
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def get_all(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        with self.lock:
+            self.ready.clear()
+            items = list(self.items)
+            self.items.clear()
+        return items
+
+
+class LoopSubscriber:
+    def __init__(self, loop):
+        self.queue = LoopQueue(loop, SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = False
+
+
+# Same stream as the Flask /feed/events route, without holding a thread per client
+async def feed_events_stream(scope, receive, send):
+    headers = dict(scope['headers'])
+    query = dict(part.split('=', 1) for part in scope['query_string'].decode('latin1').split('&') if '=' in part)
+    last_event_id = headers.get(b'last-event-id', b'').decode('latin1') or query.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    loop = asyncio.get_running_loop()
+    if isinstance(feed_events, SQLiteEventAdapter):
+        await loop.run_in_executor(executor, feed_events.start)
+    subscriber = event_broker.subscribe(last_event_id, LoopSubscriber(loop))
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        while not subscriber.dropped:
+            waiting = asyncio.ensure_future(subscriber.queue.get_all(SSE_KEEPALIVE_SECONDS))
+            await asyncio.wait({waiting, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiting.cancel()
+                return
+            events = waiting.result()
+            if not events:
+                chunk = ": keepalive\n\n"
+            else:
+                chunk = ''.join(f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n" for event_id, kind, data in events)
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        event_broker.unsubscribe(subscriber)
+        disconnected.cancel()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -0,0 +1,360 @@
+"""Seeded test data and per-route latency benchmarks for WTM Harvard.
+
+Fill a fresh database, then time every route against it:
+
+    python benchmark.py seed --db bench.db --size 100k
+    python benchmark.py run --db bench.db --save baseline.json
+    python benchmark.py run --db bench.db --compare baseline.json
+
+`run` uses the Flask test client by default, or a running server with --url.
+Never point either command at wtm.db - the write routes add real rows.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+SIZES = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+SEED_PASSWORD = 'password'
+CHUNK_SIZE = 10_000
+
+WORDS = (
+    'party pregame dorm house quad tonight music dj dancing formal themed costume '
+    'lowell quincy eliot adams kirkland winthrop leverett dunster mather cabot pforzheimer currier '
+    'snacks drinks rooftop basement courtyard karaoke playlist friends late early chill crowded '
+    'bring ticket guestlist dress halloween spring finals celebration study break'
+).split()
+PARTY_TIMES = ['19:00', '20:00', '21:00', '21:30', '22:00', '22:30', '23:00']
+
+
+def load_app(database):
+    # The app opens DATABASE_URL at import, so it has to be set first
+    os.environ['DATABASE_URL'] = database
+    import app
+    return app
+
+
+def parse_size(value):
+    value = value.lower()
+    if value in SIZES:
+        return SIZES[value]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"size must be one of {', '.join(SIZES)} or a number")
+
+
+def sentence(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize() + '.'
+
+
+def insert_in_chunks(conn, label, sql, rows):
+    """Inserts a generator of rows CHUNK_SIZE at a time, one transaction per chunk"""
+    total = 0
+    while True:
+        chunk = [row for _, row in zip(range(CHUNK_SIZE), rows)]
+        if not chunk:
+            break
+        conn.executemany(sql, chunk)
+        conn.commit()
+        total += len(chunk)
+        print(f"\r{label}: {total}", end='', flush=True)
+    print()
+
+
+def seed(args):
+    if os.path.exists(args.db):
+        sys.exit(f"{args.db} already exists - seed only fills a fresh database")
+    app = load_app(args.db)
+    rng = random.Random(args.seed)
+    size = args.size
+    user_count = max(10, size // 50)
+    now = datetime.now().replace(microsecond=0)
+
+    # Every seeded user shares one password, so hash it once
+    password_hash = app.generate_password_hash(SEED_PASSWORD, method=app.PASSWORD_HASH_METHOD)
+    locations = list(app.HARVARD_SQUARE_LOCATIONS)
+
+    conn = app.get_db_connection()
+    insert_in_chunks(
+        conn, 'users',
+        "INSERT INTO users (username, hash, display_name) VALUES (?, ?, ?)",
+        ((f"user{i}@college.harvard.edu", password_hash, f"user{i}") for i in range(1, user_count + 1)),
+    )
+
+    def parties():
+        for _ in range(size):
+            user_id = rng.randint(1, user_count)
+            location = rng.choice(locations).title()
+            latitude, longitude = app.geocode_location(location)
+            # Half in the past, half upcoming, like a live site
+            date = (now + timedelta(days=rng.randint(-60, 60))).strftime('%Y-%m-%d')
+            party_time = rng.choice(PARTY_TIMES)
+            yield (user_id, f"user{user_id}", sentence(rng, 2, 4)[:-1], location, latitude, longitude,
+                   date, party_time, app.make_starts_at(date, party_time), sentence(rng, 8, 30))
+
+    insert_in_chunks(
+        conn, 'parties',
+        """
+        INSERT INTO parties (user_id, host_name, party_name, location, latitude, longitude, date, time, starts_at, description)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        parties(),
+    )
+
+    # Posts are spread over the last year, oldest first, so ids follow created_at
+    start = now - timedelta(days=365)
+    step = timedelta(days=365) / size
+    insert_in_chunks(
+        conn, 'posts',
+        "INSERT INTO posts (user_id, content, created_at) VALUES (?, ?, ?)",
+        ((rng.randint(1, user_count), sentence(rng, 4, 40), (start + step * i).strftime('%Y-%m-%d %H:%M:%S'))
+         for i in range(size)),
+    )
+    insert_in_chunks(
+        conn, 'comments',
+        "INSERT INTO comments (post_id, user_id, content, created_at) VALUES (?, ?, ?, ?)",
+        ((post_id, rng.randint(1, user_count), sentence(rng, 3, 20),
+          (start + step * (post_id - 1 + rng.random())).strftime('%Y-%m-%d %H:%M:%S'))
+         for post_id in (rng.randint(1, size) for _ in range(size))),
+    )
+    insert_in_chunks(
+        conn, 'wishlist',
+        "INSERT OR IGNORE INTO wishlist (user_id, party_id) VALUES (?, ?)",
+        ((rng.randint(1, user_count), rng.randint(1, size)) for _ in range(size)),
+    )
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"Seeded {args.db} with {user_count} users and {size} parties, posts, comments and wishlist rows "
+          f"(password for every user: {SEED_PASSWORD!r})")
+
+
+class TestClientSession:
+    """Sends requests through app.test_client(), in this process"""
+
+    def __init__(self, app_module):
+        self.client = app_module.app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.close()
+        return response.status_code, query_count(response.headers)
+
+
+class ServerSession:
+    """Sends requests to a running server, keeping the login cookie"""
+
+    class NoRedirects(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirects()
+        )
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status, query_count(response.headers)
+        except urllib.error.HTTPError as error:
+            return error.code, query_count(error.headers)
+
+
+# The app reports its SQL count in the Server-Timing header: db;dur=1.23;desc="4 queries"
+def query_count(headers):
+    match = re.search(r'desc="(\d+) queries"', headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def sample_ids(database, rng):
+    """Picks real post and party ids so detail routes don't all hit the same row"""
+    import sqlite3
+    conn = sqlite3.connect(database)
+    post_ids = [row[0] for row in conn.execute("SELECT id FROM posts ORDER BY random() LIMIT 200")]
+    party_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM parties WHERE starts_at >= datetime('now', 'localtime') ORDER BY random() LIMIT 200"
+    )]
+    user_count = conn.execute("SELECT count(*) FROM users").fetchone()[0]
+    conn.close()
+    if not post_ids or not party_ids:
+        sys.exit("The database needs posts and upcoming parties - run `python benchmark.py seed` first")
+    return post_ids, party_ids, user_count
+
+
+def build_routes(rng, post_ids, party_ids):
+    """Each route is (name, function returning (method, path, form data))"""
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    return [
+        ('GET /', lambda: ('GET', '/', None)),
+        ('GET /list', lambda: ('GET', '/list', None)),
+        ('GET /feed', lambda: ('GET', '/feed', None)),
+        ('GET /api/feed', lambda: ('GET', '/api/feed', None)),
+        ('GET /feed/post/<id>', lambda: ('GET', f"/feed/post/{rng.choice(post_ids)}", None)),
+        ('GET /party/<id>', lambda: ('GET', f"/party/{rng.choice(party_ids)}", None)),
+        ('GET /api/parties/map', lambda: ('GET', '/api/parties/map', None)),
+        ('GET /api/parties/map?bbox', lambda: ('GET', '/api/parties/map?bbox=-71.125,42.370,-71.110,42.380', None)),
+        ('GET /search', lambda: ('GET', f"/search?q={rng.choice(WORDS)}", None)),
+        ('GET /wishlist', lambda: ('GET', '/wishlist', None)),
+        ('POST /feed/post', lambda: ('POST', '/feed/post', {'content': sentence(rng, 4, 20)})),
+        ('POST /feed/post/<id>/comment',
+         lambda: ('POST', f"/feed/post/{rng.choice(post_ids)}/comment", {'content': sentence(rng, 3, 12)})),
+        ('POST /party/<id>/wishlist', lambda: ('POST', f"/party/{rng.choice(party_ids)}/wishlist", None)),
+        ('POST /add', None),  # Filled in per worker, since the host name must match the user
+    ], tomorrow
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    app_module = None
+    if not args.url:
+        app_module = load_app(args.db)
+    # With --url, --db must be the server's database (or a copy) so the ids exist
+    post_ids, party_ids, user_count = sample_ids(args.db, rng)
+
+    routes, tomorrow = build_routes(rng, post_ids, party_ids)
+    if args.routes:
+        routes = [route for route in routes if any(part in route[0] for part in args.routes)]
+
+    # Each worker logs in as its own seeded user
+    def new_session(worker):
+        session = ServerSession(args.url) if args.url else TestClientSession(app_module)
+        user_number = worker % user_count + 1
+        status, _ = session.request('POST', '/login', {
+            'email': f"user{user_number}@college.harvard.edu", 'password': SEED_PASSWORD,
+        })
+        if status != 302:
+            sys.exit(f"Could not log in as user{user_number} (status {status}) - was the database seeded?")
+        add_party = lambda: ('POST', '/add', {
+            'host_name': f"user{user_number}", 'party_name': sentence(rng, 2, 4)[:-1],
+            'location': 'Quincy House', 'date': tomorrow, 'time': '21:00', 'description': sentence(rng, 8, 20),
+        })
+        return session, add_party
+
+    sessions = [new_session(worker) for worker in range(args.concurrency)]
+    results = {}
+    for name, make_request in routes:
+        latencies, queries, errors = [], [], 0
+        lock = threading.Lock()
+
+        def worker(index):
+            nonlocal errors
+            session, add_party = sessions[index]
+            for attempt in range(args.warmup + args.requests // args.concurrency):
+                method, path, data = (make_request or add_party)()
+                started = time.perf_counter()
+                status, query_total = session.request(method, path, data)
+                elapsed = time.perf_counter() - started
+                if attempt < args.warmup:
+                    continue
+                with lock:
+                    latencies.append(elapsed * 1000)
+                    if query_total is not None:
+                        queries.append(query_total)
+                    if status >= 400:
+                        errors += 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(worker, range(args.concurrency)))
+        wall_time = time.perf_counter() - started
+
+        latencies.sort()
+        results[name] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'throughput_rps': round(len(latencies) / wall_time, 1),
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        }
+        row = results[name]
+        print(f"{name:32} p50 {row['p50_ms']:8.2f}ms  p95 {row['p95_ms']:8.2f}ms  p99 {row['p99_ms']:8.2f}ms  "
+              f"{row['throughput_rps']:8.1f} req/s  queries {row['queries_per_request']}  errors {errors}")
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'database': args.db,
+        'target': args.url or 'test-client',
+        'concurrency': args.concurrency,
+        'routes': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        return compare(report, args.compare, args.tolerance)
+    return 0
+
+
+def compare(report, baseline_path, tolerance):
+    """Exits non-zero if any route's p95 got more than `tolerance` slower than the baseline"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['routes']
+    regressions = []
+    for name, row in report['routes'].items():
+        before = baseline.get(name)
+        if before and row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {row['p95_ms']}ms")
+        if before and before['queries_per_request'] is not None and row['queries_per_request'] is not None \
+                and row['queries_per_request'] > before['queries_per_request']:
+            regressions.append(f"{name}: queries {before['queries_per_request']} -> {row['queries_per_request']}")
+    if regressions:
+        print("Regressions against " + baseline_path + ":\n  " + "\n  ".join(regressions))
+        return 1
+    print(f"No regressions against {baseline_path}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help="fill a fresh database with synthetic data")
+    seed_parser.add_argument('--db', default='bench.db')
+    seed_parser.add_argument('--size', type=parse_size, default='1k', help="rows per table: 1k, 100k, 1m or a number")
+    seed_parser.add_argument('--seed', type=int, default=50, help="random seed, so runs are repeatable")
+
+    run_parser = commands.add_parser('run', help="time every route")
+    run_parser.add_argument('--db', default='bench.db')
+    run_parser.add_argument('--url', help="benchmark a running server instead of the test client")
+    run_parser.add_argument('--requests', type=int, default=200, help="timed requests per route")
+    run_parser.add_argument('--warmup', type=int, default=10, help="untimed requests per route and worker")
+    run_parser.add_argument('--concurrency', type=int, default=1)
+    run_parser.add_argument('--routes', nargs='*', help="only run routes whose name contains one of these")
+    run_parser.add_argument('--seed', type=int, default=50)
+    run_parser.add_argument('--save', help="write the results as a JSON baseline")
+    run_parser.add_argument('--compare', help="fail if p95 or query counts regressed against this baseline")
+    run_parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 slowdown (0.2 = 20%%)")
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed(args)
+        return 0
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
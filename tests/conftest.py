@@ -0,0 +1,35 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py opens its database at import time, so point it at a scratch file first
+os.environ['DATABASE_URL'] = os.path.join(tempfile.mkdtemp(prefix='wtm-tests-'), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as wtm  # noqa: E402
+
+usernames = itertools.count()
+
+
+@pytest.fixture
+def client():
+    wtm.app.config['TESTING'] = True
+    with wtm.app.test_client() as client:
+        yield client
+
+
+@pytest.fixture
+def register(client):
+    """Signs a new user up through /register and leaves them logged in"""
+    def register(username=None, password='correct horse'):
+        username = username or f"user{next(usernames)}"
+        response = client.post('/register', data={
+            'email': f"{username}@example.com", 'username': username, 'password': password,
+        })
+        assert response.status_code == 302, response.data
+        return username
+
+    return register
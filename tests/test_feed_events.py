@@ -0,0 +1,18 @@
+import app as wtm
+
+
+def test_sqlite_events_trim_when_batches_skip_round_ids():
+    adapter = wtm.SQLiteEventAdapter(wtm.EventBroker(), keep=50, trim_every=100)
+    adapter._started = True  # Poll by hand instead of from the background thread
+
+    conn = wtm.db_pool.acquire()
+    conn.execute("DELETE FROM feed_events")
+    conn.commit()
+    batch = 7  # Batch ends never land on a multiple of 100 until id 700
+    for _ in range(30):
+        for _ in range(batch):
+            adapter.publish('post', {'content': 'hi'})
+        adapter.poll_once()
+        count = conn.execute("SELECT COUNT(*) FROM feed_events").fetchone()[0]
+        assert count <= adapter.keep + adapter.trim_every + batch
+    conn.close()
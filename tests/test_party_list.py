@@ -0,0 +1,29 @@
+import re
+
+import app as wtm
+
+
+def party_cards(page):
+    return page[page.index('<div class="party-card">'):page.index('<!-- CSS -->')]
+
+
+def test_party_cards_are_shared_between_users(client, register):
+    host = register()
+    client.post('/add', data={
+        'host_name': host, 'party_name': 'Kazoo Night', 'location': 'Lowell House',
+        'date': '2099-01-01', 'time': '21:00',
+    })
+    conn = wtm.db_pool.acquire()
+    party_id = conn.execute("SELECT id FROM parties WHERE party_name = 'Kazoo Night'").fetchone()['id']
+    conn.close()
+    client.post(f'/party/{party_id}/wishlist')
+    host_page = client.get('/list').get_data(as_text=True)
+
+    client.get('/logout')
+    register()
+    guest_page = client.get('/list').get_data(as_text=True)
+
+    # The hearts come from the uncached wishlist list, so both users get the same card markup
+    assert party_cards(host_page) == party_cards(guest_page)
+    assert str(party_id) in re.search(r'data-wishlist="([^"]*)"', host_page).group(1).split(',')
+    assert str(party_id) not in re.search(r'data-wishlist="([^"]*)"', guest_page).group(1).split(',')
@@ -0,0 +1,15 @@
+import os
+import signal
+
+import app as wtm
+
+
+def test_login_works_after_a_hashing_worker_dies(client, register):
+    username = register(password='correct horse')
+    client.get('/logout')
+    broken = wtm.password_hasher._executor
+    os.kill(next(iter(broken._processes)), signal.SIGKILL)
+
+    response = client.post('/login', data={'email': f"{username}@example.com", 'password': 'correct horse'})
+    assert response.status_code == 302
+    assert wtm.password_hasher._executor is not broken
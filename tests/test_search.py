@@ -0,0 +1,14 @@
+def test_deleting_a_post_removes_its_comments_from_search(client, register):
+    register()
+    client.post('/feed/post', data={'content': 'Anyone going tonight?'})
+    post_id = client.get('/api/feed').get_json()['posts'][0]['id']
+    client.post(f'/feed/post/{post_id}/comment', data={'content': 'Bringing my kazoo'})
+
+    response = client.get('/api/search', query_string={'q': 'kazoo', 'type': 'comments'})
+    assert [result['id'] for result in response.get_json()['results']] == [post_id]
+
+    client.post(f'/feed/post/{post_id}/delete')
+    response = client.get('/api/search', query_string={'q': 'kazoo', 'type': 'comments'})
+    assert response.get_json()['results'] == []
+    page = client.get('/search', query_string={'q': 'kazoo'}).get_data(as_text=True)
+    assert f'/feed/post/{post_id}"' not in page